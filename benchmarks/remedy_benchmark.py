@@ -0,0 +1,165 @@
+#!/usr/bin/python
+
+# Throughput benchmark for remedy.py. Every operation runs the module as its
+# own process, the way Ansible forks do, against the local mock server (or a
+# given apibase) at increasing concurrency, and reports ops/s, p50/p99
+# latency, failures and the number of logins the server saw.
+#
+#   python benchmarks/remedy_benchmark.py --concurrency 1,4,16 --ops 100 --latency 20
+#   python benchmarks/remedy_benchmark.py --extra '{"gateway": true}'
+from __future__ import (absolute_import, division, print_function)
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from remedy_mock_server import makeserver
+
+CONST_MODULE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'remedy.py')
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def runtask(module, workdir, args):
+    fd, argsfile = tempfile.mkstemp(dir=workdir, suffix='.json')
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'ANSIBLE_MODULE_ARGS': args}, f)
+    start = time.time()
+    proc = subprocess.run([sys.executable, module, argsfile], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    elapsed = time.time() - start
+    os.remove(argsfile)
+    try:
+        result = json.loads(proc.stdout.decode())
+    except ValueError:
+        result = {'failed': True, 'msg': proc.stderr.decode()[-500:]}
+    return elapsed, result
+
+
+def stats(apibase):
+    return requests.get(apibase + '/stats', timeout=10).json()
+
+
+def runlevel(options, workdir, action, concurrency, woids):
+    base = dict(options.extra)
+    base.update({
+        'token_dir': workdir,
+        'user': options.user,
+        'password': options.password,
+        'apibase': options.apibase,
+        'action': action,
+    })
+    tasks = []
+    for i in range(options.ops):
+        args = dict(base)
+        if action == 'create':
+            args['data'] = {'values': {'Summary': 'benchmark'}}
+        elif action == 'modify':
+            args['woid'] = woids[i % len(woids)]
+            args['data'] = {'values': {'Status': 'In Progress'}}
+        else:
+            args['woid'] = woids[i % len(woids)]
+            args['data'] = {'values': {'Description': 'benchmark'}}
+            args['filename'] = options.attachment
+        tasks.append(args)
+    before = stats(options.apibase)
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda args: runtask(options.module, workdir, args), tasks))
+    wall = time.time() - start
+    after = stats(options.apibase)
+    latencies = [elapsed for elapsed, result in results]
+    failures = [result for elapsed, result in results if result.get('failed')]
+    created = [result['message'] for elapsed, result in results if action == 'create' and not result.get('failed')]
+    return {
+        'action': action,
+        'concurrency': concurrency,
+        'ops': len(results),
+        'ops_per_second': len(results) / wall if wall > 0 else 0.0,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'failures': len(failures),
+        'logins': after['logins'] - before['logins'],
+        'connections': after['connections'] - before['connections'],
+        'first_error': failures[0].get('msg') if failures else None,
+    }, created
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark remedy.py against a Remedy mock server')
+    parser.add_argument('--module', default=CONST_MODULE, help='path to remedy.py')
+    parser.add_argument('--apibase', help='use this server instead of starting the local mock')
+    parser.add_argument('--user', default='benchmark')
+    parser.add_argument('--password', default='benchmark')
+    parser.add_argument('--actions', default='create,modify,add_attachment')
+    parser.add_argument('--concurrency', default='1,2,4,8,16', help='comma separated concurrency levels')
+    parser.add_argument('--ops', type=int, default=50, help='operations per action and concurrency level')
+    parser.add_argument('--latency', type=float, default=0, help='mock server latency per request, in ms')
+    parser.add_argument('--token-ttl', type=int, default=3600, help='mock server token lifetime, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='mock server error injection rate')
+    parser.add_argument('--attachment-size', type=int, default=64 * 1024, help='attachment size, in bytes')
+    parser.add_argument('--extra', default='{}', help='JSON dict of extra module args, e.g. {"gateway": true}')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    options = parser.parse_args()
+    options.extra = json.loads(options.extra)
+
+    server = None
+    if not options.apibase:
+        server = makeserver('127.0.0.1', 0, options.latency, options.token_ttl, options.error_rate)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        options.apibase = 'http://127.0.0.1:%d' % server.server_address[1]
+
+    workdir = tempfile.mkdtemp(prefix='remedy_benchmark_')
+    options.attachment = os.path.join(workdir, 'attachment.bin')
+    with open(options.attachment, 'wb') as f:
+        f.write(os.urandom(options.attachment_size))
+
+    rows = []
+    woids = []
+    try:
+        for action in options.actions.split(','):
+            for concurrency in [int(c) for c in options.concurrency.split(',')]:
+                if action != 'create' and not woids:
+                    row, created = runlevel(options, workdir, 'create', concurrency, woids)
+                    woids.extend(created)
+                    if not woids:
+                        # Nothing to modify or attach to: report the level
+                        # as skipped rather than running it.
+                        reason = 'no Work Orders created (%s)' % (row['first_error'] or 'no result')
+                        rows.append({'action': action, 'concurrency': concurrency, 'ops': 0, 'skipped': reason})
+                        if not options.json:
+                            print('%-15s c=%-3d skipped: %s' % (action, concurrency, reason[:200]))
+                        continue
+                row, created = runlevel(options, workdir, action, concurrency, woids)
+                woids.extend(created)
+                rows.append(row)
+                if not options.json:
+                    print('%-15s c=%-3d ops=%-5d %8.1f ops/s  p50 %7.3fs  p99 %7.3fs  failures %-4d logins %-4d connections %d'
+                          % (row['action'], row['concurrency'], row['ops'], row['ops_per_second'],
+                             row['p50'], row['p99'], row['failures'], row['logins'], row['connections']))
+                    if row['first_error']:
+                        print('    first error: %s' % row['first_error'][:200])
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+        if server is not None:
+            server.shutdown()
+    if options.json:
+        print(json.dumps(rows, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+#!/usr/bin/python
+
+# Local stand-in for the BMC Remedy AR REST API, enough of it to exercise
+# remedy.py without a real server:
+#
+#   POST /api/jwt/login                                    -> AR-JWT token
+#   POST /api/jwt/logout
+#   POST /api/arsys/v1/entry/WOI:WorkOrderInterface_Create -> WorkOrder_ID
+#   GET  /api/arsys/v1/entry/WOI:WorkOrder?q=...           -> entries (offset/limit paging)
+#   GET  /api/arsys/v1/entry/WOI:WorkOrder/<Request ID>
+#   PUT  /api/arsys/v1/entry/WOI:WorkOrder/<Request ID>
+#   POST /api/arsys/v1/entry/WOI:WorkInfo                  -> multipart attachment
+#   GET  /stats                                            -> request counters
+#
+# Latency, token lifetime and error injection are set on the command line:
+#
+#   python benchmarks/remedy_mock_server.py --port 8080 --latency 50 --token-ttl 3600 --error-rate 0.05
+from __future__ import (absolute_import, division, print_function)
+import argparse
+import base64
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+CONST_API = '/api/arsys/v1/entry'
+
+
+class RemedyState(object):
+    def __init__(self, latency, tokenttl, errorrate, errorstatus):
+        self.latency = latency
+        self.tokenttl = tokenttl
+        self.errorrate = errorrate
+        self.errorstatus = errorstatus
+        self.lock = threading.Lock()
+        self.tokens = set()
+        self.workorders = {}
+        self.requestids = {}
+        self.stats = {'connections': 0, 'logins': 0, 'logouts': 0, 'creates': 0, 'queries': 0,
+                      'gets': 0, 'puts': 0, 'attachments': 0, 'attachment_bytes': 0,
+                      'unauthorized': 0, 'injected_errors': 0}
+
+    def count(self, key, value=1):
+        with self.lock:
+            self.stats[key] += value
+
+    def newtoken(self):
+        header = base64.urlsafe_b64encode(b'{"alg":"HS256","typ":"JWT"}').rstrip(b'=').decode()
+        claims = {'exp': int(time.time()) + self.tokenttl, 'jti': uuid.uuid4().hex}
+        payload = base64.urlsafe_b64encode(json.dumps(claims).encode()).rstrip(b'=').decode()
+        token = header + '.' + payload + '.mock'
+        with self.lock:
+            self.tokens.add(token)
+        return token
+
+    def validtoken(self, token):
+        with self.lock:
+            if token not in self.tokens:
+                return False
+        try:
+            payload = token.split('.')[1]
+            payload += '=' * (-len(payload) % 4)
+            return json.loads(base64.urlsafe_b64decode(payload).decode())['exp'] > time.time()
+        except (IndexError, ValueError, KeyError):
+            return False
+
+    def query(self, query):
+        # Qualifications naming Work Order IDs return those WOs; any other one
+        # is treated as "all WOs", filtered by 'Status' = "..." when present.
+        qualification = query.get('q', [''])[0]
+        woids = re.findall(r"'Work Order ID'\s*=\s*\"([^\"]+)\"", qualification)
+        status = re.findall(r"'Status'\s*=\s*\"([^\"]+)\"", qualification)
+        with self.lock:
+            if woids:
+                entries = [self.workorders[woid] for woid in woids if woid in self.workorders]
+            else:
+                entries = [entry for entry in self.workorders.values() if not status or entry['Status'] in status]
+            entries = [dict(entry) for entry in sorted(entries, key=lambda e: e['Request ID'])]
+        offset = int(query.get('offset', ['0'])[0])
+        limit = int(query.get('limit', ['0'])[0]) or len(entries)
+        entries = entries[offset:offset + limit]
+        fields = re.match(r'values\((.*)\)', query.get('fields', [''])[0])
+        if fields:
+            names = fields.group(1).split(',')
+            entries = [dict((k, v) for k, v in entry.items() if k in names) for entry in entries]
+        return [{'values': entry} for entry in entries]
+
+    def create(self, values):
+        with self.lock:
+            number = len(self.workorders) + 1
+            woid = 'WO%010d' % number
+            requestid = 'AGGAA%010d' % number
+            entry = {'Request ID': requestid, 'Work Order ID': woid, 'Status': 'Assigned'}
+            for key, value in values.items():
+                if key not in entry:
+                    entry[key] = value
+            self.workorders[woid] = entry
+            self.requestids[requestid] = woid
+            return woid
+
+
+class RemedyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.state.count('connections')
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=b'', contenttype='application/json', headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        elif not isinstance(body, bytes):
+            body = str(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', contenttype)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def readbody(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                length = int(self.rfile.readline().strip(), 16)
+                if length == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(length))
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def delayed(self):
+        if self.state.latency:
+            time.sleep(self.state.latency / 1000.0)
+
+    def authorized(self):
+        token = self.headers.get('Authorization', '')
+        if token.startswith('AR-JWT ') and self.state.validtoken(token[7:]):
+            return True
+        self.state.count('unauthorized')
+        self.reply(401, [{'messageType': 'ERROR', 'messageText': 'Authentication failed', 'messageNumber': 623}])
+        return False
+
+    def injected(self):
+        if self.state.errorrate and random.random() < self.state.errorrate:
+            self.state.count('injected_errors')
+            headers = {'Retry-After': '1'} if self.state.errorstatus == 429 else None
+            self.reply(self.state.errorstatus, [{'messageType': 'ERROR', 'messageText': 'Injected error'}], headers=headers)
+            return True
+        return False
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.readbody()
+        self.delayed()
+        if url.path == '/api/jwt/login':
+            self.state.count('logins')
+            return self.reply(200, self.state.newtoken(), 'text/plain')
+        if url.path == '/api/jwt/logout':
+            self.state.count('logouts')
+            return self.reply(204)
+        if not self.authorized() or self.injected():
+            return
+        if url.path == CONST_API + '/WOI:WorkOrderInterface_Create':
+            self.state.count('creates')
+            woid = self.state.create(json.loads(body.decode() or '{}').get('values', {}))
+            return self.reply(201, {'values': {'WorkOrder_ID': woid}})
+        if url.path == CONST_API + '/WOI:WorkInfo':
+            self.state.count('attachments')
+            self.state.count('attachment_bytes', len(body))
+            return self.reply(201, headers={'Location': self.path + '/WI' + uuid.uuid4().hex[:12]})
+        self.reply(404)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            with self.state.lock:
+                return self.reply(200, dict(self.state.stats))
+        self.delayed()
+        if not self.authorized() or self.injected():
+            return
+        query = parse_qs(url.query)
+        if url.path == CONST_API + '/WOI:WorkOrder':
+            self.state.count('queries')
+            return self.reply(200, {'entries': self.state.query(query)})
+        if url.path.startswith(CONST_API + '/WOI:WorkOrder/'):
+            self.state.count('gets')
+            requestid = url.path.rsplit('/', 1)[1]
+            with self.state.lock:
+                woid = self.state.requestids.get(requestid)
+                if woid is not None:
+                    return self.reply(200, {'values': dict(self.state.workorders[woid])})
+        self.reply(404, [{'messageType': 'ERROR', 'messageText': 'Entry does not exist'}])
+
+    def do_PUT(self):
+        url = urlparse(self.path)
+        body = self.readbody()
+        self.delayed()
+        if not self.authorized() or self.injected():
+            return
+        if url.path.startswith(CONST_API + '/WOI:WorkOrder/'):
+            self.state.count('puts')
+            requestid = url.path.rsplit('/', 1)[1]
+            with self.state.lock:
+                woid = self.state.requestids.get(requestid)
+                if woid is not None:
+                    self.state.workorders[woid].update(json.loads(body.decode()).get('values', {}))
+                    return self.reply(204)
+        self.reply(404, [{'messageType': 'ERROR', 'messageText': 'Entry does not exist'}])
+
+
+def makeserver(host, port, latency=0, tokenttl=3600, errorrate=0.0, errorstatus=503):
+    handler = type('Handler', (RemedyHandler,), {'state': RemedyState(latency, tokenttl, errorrate, errorstatus)})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local mock of the Remedy AR REST API')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0, help='added latency per request, in ms')
+    parser.add_argument('--token-ttl', type=int, default=3600, help='lifetime of issued tokens, in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of authenticated requests that fail')
+    parser.add_argument('--error-status', type=int, default=503, help='status code of injected failures')
+    args = parser.parse_args()
+    server = makeserver(args.host, args.port, args.latency, args.token_ttl, args.error_rate, args.error_status)
+    print('Remedy mock listening on http://%s:%d' % (args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
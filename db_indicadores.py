@@ -3,8 +3,18 @@
 from __future__ import (absolute_import, division, print_function)
 from ansible.module_utils.basic import AnsibleModule
 from dateutil.parser import parse
-from datetime import datetime
+from datetime import datetime, timedelta
 import psycopg2
+import psycopg2.extras
+import atexit
+import json
+import os
+import select
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
 import time
 import random
 import paramiko
@@ -99,34 +109,164 @@ def validateData(data):
     GLOBAL_ERRORS += 1
   return data;
  
+# sshTransport, forwardChannel and openTunnel are the same in db_indicadores.py,
+# indicadores.py and indicadores_writer.py. Each module has to run as a single
+# file, so there is no shared module_utils; change all three copies together.
+def sshTransport(config):
+  global TUNNEL_CLIENT
+  # One SSH transport for every forwarded connection, reopened if it drops.
+  with TUNNEL_LOCK:
+    if TUNNEL_CLIENT is None or TUNNEL_CLIENT.get_transport() is None or not TUNNEL_CLIENT.get_transport().is_active():
+      p = paramiko.SSHClient()
+      p.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+      p.connect(config["ssh_server"], port=int(config.get("ssh_port", 22)), username=config["ssh_user"], password=config["ssh_password"])
+      p.get_transport().set_keepalive(30)
+      TUNNEL_CLIENT = p
+    return TUNNEL_CLIENT.get_transport()
+
+def forwardChannel(config,sock):
+  try:
+    chan = sshTransport(config).open_channel("direct-tcpip", (config["db_server"], int(config.get("db_port", 5432))), ("127.0.0.1", 0))
+  except Exception:
+    sock.close()
+    return
+  try:
+    while True:
+      readable, _, _ = select.select([sock, chan], [], [])
+      if sock in readable:
+        chunk = sock.recv(65536)
+        if not chunk:
+          break
+        chan.sendall(chunk)
+      if chan in readable:
+        chunk = chan.recv(65536)
+        if not chunk:
+          break
+        sock.sendall(chunk)
+  finally:
+    chan.close()
+    sock.close()
+
+def openTunnel(config):
+  global TUNNEL_DIR
+  # Returns the host and port psycopg2 connects to for db_server:db_port
+  # through the SSH server. The listener is a Unix socket named the way libpq
+  # expects (.s.PGSQL.<port>) in a fresh 0700 directory, so other local users
+  # cannot use it as a relay to the database the way they could a TCP port.
+  port = int(str(config.get("db_port", "")).strip() or 5432)
+  if TUNNEL_DIR is None:
+    sshTransport(config)
+    path = tempfile.mkdtemp(prefix="tunnel_", dir=stateDir(config))
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(os.path.join(path, ".s.PGSQL."+str(port)))
+    listener.listen(16)
+    atexit.register(closeTunnel, listener, path)
+    def accept():
+      while True:
+        sock, _ = listener.accept()
+        threading.Thread(target=forwardChannel, args=(config, sock), daemon=True).start()
+    threading.Thread(target=accept, daemon=True).start()
+    TUNNEL_DIR = path
+  return TUNNEL_DIR, port
+
+def closeTunnel(listener,path):
+  listener.close()
+  shutil.rmtree(path, ignore_errors=True)
+
+def tunnelConnection(config):
+  global TUNNEL_CONN
+  # The one database connection of this run for method ssh_tunnel.
+  if TUNNEL_CONN is None or TUNNEL_CONN.closed:
+    host, port = openTunnel(config)
+    TUNNEL_CONN = psycopg2.connect(dbname=config["db_name"], user=config["db_user"], password=config["db_password"], host=host, port=port)
+  return TUNNEL_CONN
+
+def stateDir(config):
+  # Private directory for the spool, the catalog cache and the writer socket.
+  # Not /tmp: it is often tmpfs, so unflushed rows would not survive a
+  # reboot, and any local user could create the files there first.
+  path = os.path.expanduser(config.get("state_dir") or CONST_STATEDIR)
+  if not os.path.isdir(path):
+    os.makedirs(path, 0o700, exist_ok=True)
+  st = os.stat(path)
+  if st.st_uid != os.getuid() or st.st_mode & 0o077:
+    raise Exception("Refusing state directory "+path+": it must be owned by the current user and mode 0700")
+  return path
+
+def ownedPath(path):
+  # Refuses an existing file another user owns or may write to, or a symlink.
+  if os.path.lexists(path):
+    st = os.lstat(path)
+    if os.path.islink(path) or st.st_uid != os.getuid() or st.st_mode & 0o022:
+      raise Exception("Refusing "+path+": it must be a file owned by the current user and not writable by others")
+  return path
+
+def statePath(config,option,name):
+  # config[option] when set, otherwise name in the state directory.
+  if config.get(option):
+    return ownedPath(os.path.expanduser(config[option]))
+  return os.path.join(stateDir(config), name)
+
+def writerRequest(config,query,values,fetch=None,rows=None,pagesize=None):
+  # Runs one statement through the local writer service (indicadores_writer.py),
+  # which holds a bounded connection pool to the database. With rows, query
+  # has a single VALUES %s and the rows are loaded in one transaction.
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  s.settimeout(float(config.get("writer_timeout", 60)))
+  try:
+    try:
+      s.connect(statePath(config, "writer_socket", CONST_WRITERSOCKET))
+    except socket.error as e:
+      raise Exception("Writer service not reachable at "+statePath(config, "writer_socket", CONST_WRITERSOCKET)+": "+str(e))
+    request = {"query": query, "values": values, "fetch": fetch}
+    if rows is not None:
+      request.update(rows=rows, page_size=pagesize)
+    s.sendall((json.dumps(request)+"\n").encode())
+    reply = s.makefile('rb').readline()
+  finally:
+    s.close()
+  if not reply:
+    raise Exception("Writer service closed the connection without replying")
+  reply = json.loads(reply.decode())
+  if "error" in reply:
+    raise Exception("WRITER SERVICE ERROR: "+reply["error"])
+  return reply
+
+def calculateRow(data,now):
+  # Derived columns of one validated record, in CONST_INSERT column order.
+  time = now.strftime("%Y-%m-%d %H:%M:%S")
+  endtime = now.strftime('%s')
+  #data["playbook_start_timestamp"] = int(endtime)//1 - random.randint(1,600)
+  autotime =  (int(endtime)//1 - int(data["playbook_start_timestamp"])//1)/3600
+  svtimebyexec = float(data["manual_time"]) - autotime
+  if (svtimebyexec < 0):
+    raise Exception("Exception: Calculated saved time value is a negative number")
+  totalsvtime = svtimebyexec * float(data["auto_execs"])
+  svtime = svtimebyexec * float(data["manual_execs"])
+  opttime = totalsvtime - svtime
+  optpct = opttime/svtime
+  svftes = totalsvtime/150
+  optftes = opttime/150
+  ftebyexec = svtimebyexec/160
+  transactionid = data["transaction_identifier"]+"."+now.strftime("%Y%m%d.%H%M%S.%f")
+  return [time,data["bot_name"],data["client"],data["area"],data["platform"],data["creator"],data["type"],data["function"],data["specialist"],data["exec_type"],float(data["manual_execs"]),float(data["auto_execs"]),float(data["manual_time"]),float(autotime),float(svtimebyexec),float(totalsvtime),float(svtime),float(opttime),float(optpct),float(svftes),float(optftes),float(ftebyexec),transactionid,data["woid"],data["ci"],data["technology"]]
+
+def sqlLiteral(value):
+  if isinstance(value, (int, float)):
+    return str(value)
+  return "'"+str(value).replace("'", "''")+"'"
+
 def insertData(config,data):
   global GLOBAL_MESSAGE
   global GLOBAL_ERRORS
   # Calculate variables to be inserted
   try:
-    now = datetime.now()
-    time = now.strftime("%Y-%m-%d %H:%M:%S")
-    endtime = now.strftime('%s')
-    #data["playbook_start_timestamp"] = int(endtime)//1 - random.randint(1,600)
-    autotime =  (int(endtime)//1 - int(data["playbook_start_timestamp"])//1)/3600
-    svtimebyexec = float(data["manual_time"]) - autotime
-    if (svtimebyexec < 0):
-      raise Exception("Exception: Calculated saved time value is a negative number")
-    totalsvtime = svtimebyexec * float(data["auto_execs"])
-    svtime = svtimebyexec * float(data["manual_execs"])
-    opttime = totalsvtime - svtime
-    optpct = opttime/svtime
-    svftes = totalsvtime/150
-    optftes = opttime/150
-    ftebyexec = svtimebyexec/160
-    transactionid = data["transaction_identifier"]+"."+now.strftime("%Y%m%d.%H%M%S.%f")
+    values = calculateRow(data,datetime.now())
     #print("Variables calculated")
     if "port" not in config.keys() or not config["port"].strip():
       config["port"] = 5432
     if config["method"] == "ssh":
-      query = "insert into indicadores (time,botname,client,area,platform,creator,type,function,specialist,exectype,manexecs,autoexecs,mantime,autotime,svtimebyexec,totalsvtime,svtime,opttime,optpct,svftes,optftes,ftebyexec,transactionid,ticketid,ci,technology) values "
-      values = "('"+time+"','"+data["bot_name"]+"','"+data["client"]+"','"+data["area"]+"','"+data["platform"]+"','"+data["creator"]+"','"+data["type"]+"','"+data["function"]+"','"+data["specialist"]+"','"+data["exec_type"]+"',"+data["manual_execs"]+","+data["auto_execs"]+","+data["manual_time"]+","+str(autotime)+","+str(svtimebyexec)+","+str(totalsvtime)+","+str(svtime)+","+str(opttime)+","+str(optpct)+","+str(svftes)+","+str(optftes)+","+str(ftebyexec)+",'"+transactionid+"','"+data["woid"]+"','"+data["ci"]+"','"+data["technology"]+"')"
-      completequery = query+values
+      completequery = CONST_INSERT+" values ("+",".join([sqlLiteral(v) for v in values])+")"
       completecommand = "PGPASSWORD=\""+config["db_password"]+"\" psql -h "+config["db_server"]+" -U "+config["db_user"]+" -d "+config["db_name"]+" -p "+config["db_port"]+" -c \""+completequery+"\""
       p = paramiko.SSHClient()
       p.set_missing_host_key_policy(paramiko.AutoAddPolicy())   # This script doesn't work for me unless this line is added!
@@ -141,19 +281,151 @@ def insertData(config,data):
         GLOBAL_ERRORS += 1
     elif config["method"] == "postgres":
       conn = psycopg2.connect(dbname=config["db_name"], user=config["db_user"], password=config["db_password"], host=config["db_server"],port=config["db_port"])
+      try:
+        cursor = conn.cursor()
+        cursor.execute(CONST_INSERT+" values ("+", ".join(["%s"]*len(values))+")",values)
+        conn.commit()
+      finally:
+        conn.close()
+    elif config["method"] == "pool":
+      writerRequest(config,CONST_INSERT+" values ("+", ".join(["%s"]*len(values))+")",values)
+    elif config["method"] == "ssh_tunnel":
+      conn = tunnelConnection(config)
+      with conn:
+        conn.cursor().execute(CONST_INSERT+" values ("+", ".join(["%s"]*len(values))+")",values)
+    elif config["method"] == "spool":
+      spoolRows(config,[values])
+  except Exception as e:
+    GLOBAL_MESSAGE += str(e)
+    GLOBAL_ERRORS += 1
+
+def spoolDestination(config):
+  # The database a spooled row is meant for; indicadores_writer.py only
+  # flushes the rows of the database in its own --config.
+  return str(config["db_server"])+":"+(str(config.get("db_port", "")).strip() or "5432")+"/"+str(config["db_name"])
+
+def spoolRows(config,rows):
+  # Appends rows to the local spool that indicadores_writer.py drains into
+  # the database. WAL keeps the spool consistent if a fork dies mid-write.
+  columns = [c.strip() for c in CONST_COLUMNS.split(",")]
+  conn = sqlite3.connect(statePath(config, "spool_file", CONST_SPOOLFILE), timeout=30)
+  try:
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(CONST_SPOOLSCHEMA)
+    if "destination" not in [c[1] for c in conn.execute("PRAGMA table_info(spool)")]:
+      # Spool created before rows recorded their database.
+      try:
+        conn.execute("ALTER TABLE spool ADD COLUMN destination TEXT NOT NULL DEFAULT ''")
+      except sqlite3.OperationalError:
+        pass
+    destination = spoolDestination(config)
+    with conn:
+      conn.executemany("INSERT INTO spool (target, columns, transactionid, row, created, destination) VALUES (?, ?, ?, ?, ?, ?)",
+                       [(CONST_TABLE, ",".join(columns), row[columns.index("transactionid")], json.dumps(row), time.time(), destination) for row in rows])
+  finally:
+    conn.close()
+
+def loadRows(config,rows):
+  # Loads all rows in one transaction, config.chunk_size rows per multi-row
+  # INSERT.
+  chunksize = int(config.get("chunk_size", CONST_CHUNKSIZE))
+  if "port" not in config.keys() or not str(config["port"]).strip():
+    config["port"] = 5432
+  if config["method"] == "ssh":
+    statements = [CONST_INSERT+" values "+",".join(["("+",".join([sqlLiteral(v) for v in row])+")" for row in rows[i:i+chunksize]])+";" for i in range(0, len(rows), chunksize)]
+    # The statements go through psql's stdin, which has no length limit,
+    # and -1 wraps them in a single transaction.
+    completecommand = "PGPASSWORD=\""+config["db_password"]+"\" psql -1 -v ON_ERROR_STOP=1 -h "+config["db_server"]+" -U "+config["db_user"]+" -d "+config["db_name"]+" -p "+str(config["db_port"])+" -f -"
+    p = paramiko.SSHClient()
+    p.set_missing_host_key_policy(paramiko.AutoAddPolicy())   # This script doesn't work for me unless this line is added!
+    p.connect(config["ssh_server"], port=config["ssh_port"], username=config["ssh_user"], password=config["ssh_password"])
+    try:
+      stdin, stdout, stderr = p.exec_command(completecommand)
+      stdin.write("\n".join(statements)+"\n")
+      stdin.channel.shutdown_write()
+      opt = "".join(stdout.readlines())
+      err = "".join(stderr.readlines())
+      if stdout.channel.recv_exit_status() != 0:
+        raise Exception("POSTGRESQL ERROR: stdout: "+opt+"; stderr: "+err)
+    finally:
+      p.close()
+  elif config["method"] == "postgres":
+    conn = psycopg2.connect(dbname=config["db_name"], user=config["db_user"], password=config["db_password"], host=config["db_server"],port=config["db_port"])
+    try:
       cursor = conn.cursor()
-      query = "insert into indicadores (time,botname,client,area,platform,creator,type,function,specialist,exectype,manexecs,autoexecs,mantime,autotime,svtimebyexec,totalsvtime,svtime,opttime,optpct,svftes,optftes,ftebyexec,transactionid,ticketid,ci,technology) values (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)"
-      values = [time,data["bot_name"],data["client"],data["area"],data["platform"],data["creator"],data["type"],data["function"],data["specialist"],data["exec_type"],float(data["manual_execs"]),float(data["auto_execs"]),float(data["manual_time"]),float(autotime),float(svtimebyexec),float(totalsvtime),float(svtime),float(opttime),float(optpct),float(svftes),float(optftes),float(ftebyexec),transactionid,data["woid"],data["ci"],data["technology"]]
-      cursor.execute(query,values)
+      psycopg2.extras.execute_values(cursor, CONST_INSERT+" values %s", rows, page_size=chunksize)
+      conn.commit()
+    finally:
+      conn.close()
+  elif config["method"] == "pool":
+    writerRequest(config,CONST_INSERT+" values %s",None,rows=rows,pagesize=chunksize)
+  elif config["method"] == "ssh_tunnel":
+    conn = tunnelConnection(config)
+    with conn:
+      psycopg2.extras.execute_values(conn.cursor(), CONST_INSERT+" values %s", rows, page_size=chunksize)
+  elif config["method"] == "spool":
+    spoolRows(config,rows)
+  else:
+    raise Exception("Unsupported method for records: "+str(config["method"]))
+
+def insertRecords(config,records):
+  global GLOBAL_MESSAGE
+  global GLOBAL_ERRORS
+  # Every record is validated and calculated before anything is sent; the
+  # ones that fail are rejected with their own messages and the rest are
+  # loaded together. Returns (inserted, rejected).
+  now = datetime.now()
+  rows = []
+  rejected = []
+  for index, record in enumerate(records):
+    message, errors = GLOBAL_MESSAGE, GLOBAL_ERRORS
+    GLOBAL_MESSAGE, GLOBAL_ERRORS = "", 0
+    try:
+      record = validateData(dict(record))
+      if GLOBAL_ERRORS == 0:
+        # One microsecond apart so every record gets its own transactionid.
+        row = calculateRow(record,now+timedelta(microseconds=index))
+    except Exception as e:
+      GLOBAL_MESSAGE += str(e)
+      GLOBAL_ERRORS += 1
+    if GLOBAL_ERRORS > 0:
+      rejected.append({"index": index, "error": GLOBAL_MESSAGE.strip()})
+    else:
+      rows.append(row)
+    GLOBAL_MESSAGE, GLOBAL_ERRORS = message, errors
+  if not rows:
+    return 0, rejected
+  try:
+    loadRows(config,rows)
   except Exception as e:
     GLOBAL_MESSAGE += str(e)
     GLOBAL_ERRORS += 1
+    return 0, rejected
+  return len(rows), rejected
   
     
 
 # Module constants definition
 GLOBAL_MESSAGE = ""
 GLOBAL_ERRORS = 0
+CONST_STATEDIR = "~/.indicadores"
+CONST_WRITERSOCKET = "writer.sock"
+CONST_SPOOLFILE = "spool.db"
+# Same table as in indicadores_writer.py, which drains the spool; spoolRows and
+# spoolDestination are repeated in db_indicadores.py and indicadores.py. Keep
+# the schema, the destination migration and the key in step across the three.
+CONST_SPOOLSCHEMA = ("CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, target TEXT NOT NULL, "
+                     "columns TEXT NOT NULL, transactionid TEXT NOT NULL, row TEXT NOT NULL, created REAL NOT NULL, "
+                     "destination TEXT NOT NULL DEFAULT '')")
+TUNNEL_CLIENT = None
+TUNNEL_DIR = None
+TUNNEL_CONN = None
+TUNNEL_LOCK = threading.Lock()
+CONST_CHUNKSIZE = 500
+CONST_TABLE = "indicadores"
+CONST_COLUMNS = "time,botname,client,area,platform,creator,type,function,specialist,exectype,manexecs,autoexecs,mantime,autotime,svtimebyexec,totalsvtime,svtime,opttime,optpct,svftes,optftes,ftebyexec,transactionid,ticketid,ci,technology"
+CONST_INSERT = "insert into "+CONST_TABLE+" ("+CONST_COLUMNS+")"
 CONST_REQUIRED = ["bot_name", "area", "manual_time", "playbook_start_timestamp"]
 CONST_DEFAULTS = {
     "transaction_identifier" : "XXX",
@@ -175,7 +447,8 @@ def run_module():
     # define available arguments/parameters a user can pass to the module
     module_args = dict(
         config=dict(type='dict',required=True, no_log=True),
-        data=dict(type='dict', required=True)
+        data=dict(type='dict', required=False),
+        records=dict(type='list', elements='dict', required=False)
     )
 
     # seed the result dict in the object
@@ -195,6 +468,8 @@ def run_module():
     # supports check mode
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=[('data', 'records')],
+        mutually_exclusive=[('data', 'records')],
         supports_check_mode=False
     )
 
@@ -210,6 +485,27 @@ def run_module():
     result['original_message'] = "Requested create record in database'"
     
     # made any modifications to your target
+    if module.params["records"] is not None:
+      # Records are loaded in one go; the ones that do not validate are
+      # reported in errors and do not stop the others.
+      try:
+        inserted, rejected = insertRecords(module.params["config"],module.params["records"])
+        error = GLOBAL_MESSAGE
+      except Exception as e:
+        inserted, rejected = 0, []
+        error = GLOBAL_MESSAGE+str(e)
+      result["inserted"] = inserted
+      result["rejected"] = len(rejected)
+      result["errors"] = rejected
+      if inserted == 0:
+        result["message"] = "ERROR: Could not insert records into database."
+        module.fail_json(msg=error or "No valid records to insert", **result)
+      if module.params["config"].get("method") == "spool":
+        result["message"] = "SUCCESSFULLY spooled "+str(inserted)+" of "+str(len(module.params["records"]))+" records for the database"
+      else:
+        result["message"] = "SUCCESSFULLY inserted "+str(inserted)+" of "+str(len(module.params["records"]))+" records into database"
+      result["changed"] = True
+      module.exit_json(**result)
     try:
       validatedData = validateData(module.params["data"])
       #print("Data validated, inserting data...")
@@ -218,7 +514,10 @@ def run_module():
         result["message"] = "ERROR: Could not insert data into database."
         module.fail_json(msg=GLOBAL_MESSAGE, **result)
       else:
-        result["message"] = "SUCCESSFULLY inserted data into database"
+        if module.params["config"].get("method") == "spool":
+          result["message"] = "SUCCESSFULLY spooled data for the database"
+        else:
+          result["message"] = "SUCCESSFULLY inserted data into database"
         result["changed"] = True
         module.exit_json(**result)
     except Exception as e:
@@ -5,8 +5,20 @@
 from __future__ import (absolute_import, division, print_function)
 from ansible.module_utils.basic import AnsibleModule
 from dateutil.parser import parse
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from decimal import Decimal
 import psycopg2
+import psycopg2.extras
+import atexit
+import json
+import os
+import filelock
+import select
+import shutil
+import socket
+import sqlite3
+import tempfile
+import threading
 import time
 import random
 import paramiko
@@ -108,12 +120,239 @@ def validateData(data):
     GLOBAL_ERRORS += 1
   return data;
 
+# sshTransport, forwardChannel and openTunnel are the same in db_indicadores.py,
+# indicadores.py and indicadores_writer.py. Each module has to run as a single
+# file, so there is no shared module_utils; change all three copies together.
+def sshTransport(config):
+  global TUNNEL_CLIENT
+  # One SSH transport for every forwarded connection, reopened if it drops.
+  with TUNNEL_LOCK:
+    if TUNNEL_CLIENT is None or TUNNEL_CLIENT.get_transport() is None or not TUNNEL_CLIENT.get_transport().is_active():
+      p = paramiko.SSHClient()
+      p.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+      p.connect(config["ssh_server"], port=int(config.get("ssh_port", 22)), username=config["ssh_user"], password=config["ssh_password"])
+      p.get_transport().set_keepalive(30)
+      TUNNEL_CLIENT = p
+    return TUNNEL_CLIENT.get_transport()
+
+def forwardChannel(config,sock):
+  try:
+    chan = sshTransport(config).open_channel("direct-tcpip", (config["db_server"], int(config.get("db_port", 5432))), ("127.0.0.1", 0))
+  except Exception:
+    sock.close()
+    return
+  try:
+    while True:
+      readable, _, _ = select.select([sock, chan], [], [])
+      if sock in readable:
+        chunk = sock.recv(65536)
+        if not chunk:
+          break
+        chan.sendall(chunk)
+      if chan in readable:
+        chunk = chan.recv(65536)
+        if not chunk:
+          break
+        sock.sendall(chunk)
+  finally:
+    chan.close()
+    sock.close()
+
+def openTunnel(config):
+  global TUNNEL_DIR
+  # Returns the host and port psycopg2 connects to for db_server:db_port
+  # through the SSH server. The listener is a Unix socket named the way libpq
+  # expects (.s.PGSQL.<port>) in a fresh 0700 directory, so other local users
+  # cannot use it as a relay to the database the way they could a TCP port.
+  port = int(str(config.get("db_port", "")).strip() or 5432)
+  if TUNNEL_DIR is None:
+    sshTransport(config)
+    path = tempfile.mkdtemp(prefix="tunnel_", dir=stateDir(config))
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(os.path.join(path, ".s.PGSQL."+str(port)))
+    listener.listen(16)
+    atexit.register(closeTunnel, listener, path)
+    def accept():
+      while True:
+        sock, _ = listener.accept()
+        threading.Thread(target=forwardChannel, args=(config, sock), daemon=True).start()
+    threading.Thread(target=accept, daemon=True).start()
+    TUNNEL_DIR = path
+  return TUNNEL_DIR, port
+
+def closeTunnel(listener,path):
+  listener.close()
+  shutil.rmtree(path, ignore_errors=True)
+
+def tunnelConnection(config):
+  global TUNNEL_CONN
+  # The one database connection of this run for method ssh_tunnel.
+  if TUNNEL_CONN is None or TUNNEL_CONN.closed:
+    host, port = openTunnel(config)
+    TUNNEL_CONN = psycopg2.connect(dbname=config["db_name"], user=config["db_user"], password=config["db_password"], host=host, port=port)
+  return TUNNEL_CONN
+
+def stateDir(config):
+  # Private directory for the spool, the catalog cache and the writer socket.
+  # Not /tmp: it is often tmpfs, so unflushed rows would not survive a
+  # reboot, and any local user could create the files there first.
+  path = os.path.expanduser(config.get("state_dir") or CONST_STATEDIR)
+  if not os.path.isdir(path):
+    os.makedirs(path, 0o700, exist_ok=True)
+  st = os.stat(path)
+  if st.st_uid != os.getuid() or st.st_mode & 0o077:
+    raise Exception("Refusing state directory "+path+": it must be owned by the current user and mode 0700")
+  return path
+
+def ownedPath(path):
+  # Refuses an existing file another user owns or may write to, or a symlink.
+  if os.path.lexists(path):
+    st = os.lstat(path)
+    if os.path.islink(path) or st.st_uid != os.getuid() or st.st_mode & 0o022:
+      raise Exception("Refusing "+path+": it must be a file owned by the current user and not writable by others")
+  return path
+
+def statePath(config,option,name):
+  # config[option] when set, otherwise name in the state directory.
+  if config.get(option):
+    return ownedPath(os.path.expanduser(config[option]))
+  return os.path.join(stateDir(config), name)
+
+def writerRequest(config,query,values,fetch=None,rows=None,pagesize=None):
+  # Runs one statement through the local writer service (indicadores_writer.py),
+  # which holds a bounded connection pool to the database. With rows, query
+  # has a single VALUES %s and the rows are loaded in one transaction.
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  s.settimeout(float(config.get("writer_timeout", 60)))
+  try:
+    try:
+      s.connect(statePath(config, "writer_socket", CONST_WRITERSOCKET))
+    except socket.error as e:
+      raise Exception("Writer service not reachable at "+statePath(config, "writer_socket", CONST_WRITERSOCKET)+": "+str(e))
+    request = {"query": query, "values": values, "fetch": fetch}
+    if rows is not None:
+      request.update(rows=rows, page_size=pagesize)
+    s.sendall((json.dumps(request)+"\n").encode())
+    reply = s.makefile('rb').readline()
+  finally:
+    s.close()
+  if not reply:
+    raise Exception("Writer service closed the connection without replying")
+  reply = json.loads(reply.decode())
+  if "error" in reply:
+    raise Exception("WRITER SERVICE ERROR: "+reply["error"])
+  return reply
+
+def fetchCatalog(config):
+  # The whole automatizacion id -> mantime mapping in one query. A spooling
+  # run still needs the catalog, read with config.catalog_method.
+  query = "select id, mantime from automatizacion"
+  if config["method"] == "spool":
+    config = dict(config, method=config.get("catalog_method", "postgres"))
+  if config["method"] == "ssh":
+    completecommand = "PGPASSWORD=\""+config["db_password"]+"\" psql -h "+config["db_server"]+" -U "+config["db_user"]+" -d "+config["db_name"]+" -p "+str(config["db_port"])+" -tA -F '|' -v ON_ERROR_STOP=1 -c \""+query+"\""
+    p = paramiko.SSHClient()
+    p.set_missing_host_key_policy(paramiko.AutoAddPolicy())   # This script doesn't work for me unless this line is added!
+    p.connect(config["ssh_server"], port=config["ssh_port"], username=config["ssh_user"], password=config["ssh_password"])
+    try:
+      stdin, stdout, stderr = p.exec_command(completecommand)
+      opt = stdout.readlines()
+      if stdout.channel.recv_exit_status() != 0:
+        raise Exception("POSTGRESQL ERROR: "+"".join(stderr.readlines()))
+    finally:
+      p.close()
+    rows = [line.strip().split("|", 1) for line in opt if "|" in line]
+  elif config["method"] == "postgres":
+    conn = psycopg2.connect(dbname=config["db_name"], user=config["db_user"], password=config["db_password"], host=config["db_server"],port=config["db_port"])
+    try:
+      cursor = conn.cursor()
+      cursor.execute(query)
+      rows = cursor.fetchall()
+    finally:
+      conn.close()
+  elif config["method"] == "pool":
+    rows = writerRequest(config,query,None,"all")["rows"]
+  elif config["method"] == "ssh_tunnel":
+    conn = tunnelConnection(config)
+    with conn:
+      cursor = conn.cursor()
+      cursor.execute(query)
+      rows = cursor.fetchall()
+  else:
+    raise Exception("Unsupported method: "+str(config["method"]))
+  catalog = {}
+  for autid, mantime in rows:
+    # numeric comes back as a Decimal (or a string over ssh); the cache is
+    # JSON, so keep a float, or None when it is not a number.
+    try:
+      catalog[str(autid)] = float(mantime) if mantime not in ("", None) else None
+    except (TypeError, ValueError):
+      catalog[str(autid)] = None
+  return catalog
+
+def catalogFile(config):
+  # One cached catalog per database, so tasks pointed at different databases
+  # from the same host do not read each other's mantimes.
+  if config.get("catalog_file"):
+    return ownedPath(os.path.expanduser(config["catalog_file"]))
+  key = str(config["db_server"])+"_"+str(config.get("db_port", 5432))+"_"+str(config["db_name"])
+  return os.path.join(stateDir(config), CONST_CATALOGFILE % "".join(c if c.isalnum() or c in "-." else "_" for c in key))
+
+def catalogManTimes(config,maxage):
+  global CATALOG
+  global CATALOG_FETCHED
+  # The catalog changes a few times a month, so it is kept on disk and shared
+  # by every fork; the first one to find it older than maxage seconds
+  # refreshes it under the lock while the others wait and then read the new
+  # copy. If the refresh fails a stale copy is still used.
+  if CATALOG is not None and maxage > 0:
+    return CATALOG
+  catalogfile = catalogFile(config)
+  with filelock.FileLock(catalogfile+".lock", timeout=60):
+    cached = None
+    try:
+      with open(catalogfile, 'r') as file:
+        cached = json.load(file)
+    except (IOError, ValueError):
+      pass
+    if cached is not None and time.time() - cached["fetched"] < maxage:
+      CATALOG = cached["mantimes"]
+      return CATALOG
+    try:
+      CATALOG_FETCHED = True
+      mantimes = fetchCatalog(config)
+    except Exception:
+      if cached is None:
+        raise
+      CATALOG = cached["mantimes"]
+      return CATALOG
+    with open(catalogfile+".tmp", 'w') as file:
+      json.dump({"fetched": time.time(), "mantimes": mantimes}, file)
+    os.replace(catalogfile+".tmp", catalogfile)
+    CATALOG = mantimes
+  return CATALOG
+
 def getManTime(config,autid):
   global GLOBAL_MESSAGE
   global GLOBAL_ERRORS
+  global CATALOG
   try:
     if "port" not in config.keys():
       config["port"] = 5432
+    if int(config.get("catalog_ttl", CONST_CATALOGTTL)) > 0:
+      ttl = int(config.get("catalog_ttl", CONST_CATALOGTTL))
+      mantimes = catalogManTimes(config,0 if config.get("force_refresh") and not CATALOG_FETCHED else ttl)
+      if str(autid) not in mantimes and not CATALOG_FETCHED:
+        # Possibly an id added since the cached copy was taken; refresh
+        # unless another fork just did.
+        CATALOG = None
+        mantimes = catalogManTimes(config,min(ttl, CONST_CATALOGMINAGE))
+      try:
+        return float(mantimes[str(autid)])
+      except (KeyError, TypeError, ValueError):
+        GLOBAL_MESSAGE += "Record with aut_id = "+str(autid)+" does NOT exist in catalog OR returned an invalid 'mantime' value ("+str(mantimes.get(str(autid)))+")"
+        GLOBAL_ERRORS += 1
+        return None
     if config["method"] == "ssh":
       query = "select mantime from automatizacion where id="+str(autid)+";"
       completecommand = "PGPASSWORD=\""+config["db_password"]+"\" psql -h "+config["db_server"]+" -U "+config["db_user"]+" -d "+config["db_name"]+" -p "+str(config["db_port"])+" -tc \""+query+"\"" +" | head -1 | tr -d ' '"
@@ -131,11 +370,14 @@ def getManTime(config,autid):
         GLOBAL_ERRORS += 1 
     elif config["method"] == "postgres":
       conn = psycopg2.connect(dbname=config["db_name"], user=config["db_user"], password=config["db_password"], host=config["db_server"],port=config["db_port"])
-      cursor = conn.cursor()
-      query="select mantime from automatizacion where id=%s"
-      values = str(autid)
-      cursor.execute(query,values)
-      result=cursor.fetchone()
+      try:
+        cursor = conn.cursor()
+        query="select mantime from automatizacion where id=%s"
+        values = str(autid)
+        cursor.execute(query,values)
+        result=cursor.fetchone()
+      finally:
+        conn.close()
       try:
         mantime=float(result[0])
         return mantime
@@ -143,31 +385,133 @@ def getManTime(config,autid):
         GLOBAL_MESSAGE += "Record with aut_id = "+str(autid)+" does NOT exist in catalog OR returned an invalid 'mantime' value ("+opt+")"
         GLOBAL_ERRORS += 1
       return mantime
+    elif config["method"] == "pool":
+      result = writerRequest(config,"select mantime from automatizacion where id=%s",[autid],"one")["rows"][0]
+      try:
+        return float(result[0])
+      except (TypeError, ValueError):
+        GLOBAL_MESSAGE += "Record with aut_id = "+str(autid)+" does NOT exist in catalog OR returned an invalid 'mantime' value ("+str(result)+")"
+        GLOBAL_ERRORS += 1
+    elif config["method"] == "ssh_tunnel":
+      conn = tunnelConnection(config)
+      with conn:
+        cursor = conn.cursor()
+        cursor.execute("select mantime from automatizacion where id=%s",[autid])
+        result = cursor.fetchone()
+      try:
+        return float(result[0])
+      except (TypeError, ValueError):
+        GLOBAL_MESSAGE += "Record with aut_id = "+str(autid)+" does NOT exist in catalog OR returned an invalid 'mantime' value ("+str(result)+")"
+        GLOBAL_ERRORS += 1
   except Exception as e:
     GLOBAL_MESSAGE += str(e)
     GLOBAL_ERRORS += 1
  
+def calculateRow(data,now,mantime):
+  # Derived columns of one validated record, in CONST_INSERT column order.
+  time = now.strftime("%Y-%m-%d %H:%M:%S")
+  endtime = now.strftime('%s')
+  autotime =  (int(endtime)//1 - int(data["playbook_start_timestamp"])//1)/3600
+  svtime = mantime - autotime
+  svfte = svtime/150
+  if autotime < 0 or svtime < 0:
+    raise Exception("Exception: autotime or svtime or both are negative numbers.")
+  transactionid = data["transaction_identifier"]+"."+now.strftime("%Y%m%d.%H%M%S.%f")
+  return [time,data["aut_id"],autotime,svtime,transactionid,data["woid"],svfte]
+
+def sqlLiteral(value):
+  if isinstance(value, (int, float)):
+    return str(value)
+  return "'"+str(value).replace("'", "''")+"'"
+
+def insertServerSide(config,data):
+  global GLOBAL_MESSAGE
+  global GLOBAL_ERRORS
+  # One INSERT ... SELECT joined on automatizacion: the database reads
+  # mantime, computes svtime and svfte, refuses negative values and returns
+  # the inserted row, so there is no separate catalog lookup to race with.
+  now = datetime.now()
+  values = {
+    "time": now.strftime("%Y-%m-%d %H:%M:%S"),
+    "autid": data["aut_id"],
+    "autotime": (int(now.strftime('%s'))//1 - int(data["playbook_start_timestamp"])//1)/3600,
+    "transactionid": data["transaction_identifier"]+"."+now.strftime("%Y%m%d.%H%M%S.%f"),
+    "ticketid": data["woid"]
+  }
+  if values["autotime"] < 0:
+    raise Exception("Exception: autotime or svtime or both are negative numbers.")
+  if config["method"] == "ssh":
+    query = CONST_INSERTSELECT
+    for key in values:
+      query = query.replace("%("+key+")s", sqlLiteral(values[key]))
+    completecommand = "PGPASSWORD=\""+config["db_password"]+"\" psql -h "+config["db_server"]+" -U "+config["db_user"]+" -d "+config["db_name"]+" -p "+str(config["db_port"])+" -A -F '|' -c \""+query+"\""
+    p = paramiko.SSHClient()
+    p.set_missing_host_key_policy(paramiko.AutoAddPolicy())   # This script doesn't work for me unless this line is added!
+    p.connect(config["ssh_server"], port=config["ssh_port"], username=config["ssh_user"], password=config["ssh_password"])
+    try:
+      stdin, stdout, stderr = p.exec_command(completecommand)
+      opt = stdout.readlines()
+      err = "".join(stderr.readlines())
+    finally:
+      p.close()
+    # Header line, the returned row, the row count and the command tag. The
+    # tag says whether the row went in; the row itself is only read for the
+    # values the database computed.
+    if not any(line.startswith("INSERT 0 ") for line in opt):
+      raise Exception("POSTGRESQL ERROR: stdout: "+"".join(opt)+"; stderr: "+err)
+    row = None
+    if any(line.strip() == "INSERT 0 1" for line in opt):
+      row = dict(values, svtime=None, svfte=None)
+      parts = opt[1].rstrip("\n").split("|") if len(opt) > 1 else []
+      if len(parts) >= 7:
+        # transactionid and ticketid may hold the separator; every other
+        # column is a timestamp or a number.
+        row.update(zip(["time", "autid", "autotime", "svtime"], parts[:4]))
+        row["svfte"] = parts[-1]
+  else:
+    if config["method"] == "postgres":
+      conn = psycopg2.connect(dbname=config["db_name"], user=config["db_user"], password=config["db_password"], host=config["db_server"],port=config["db_port"])
+      try:
+        cursor = conn.cursor()
+        cursor.execute(CONST_INSERTSELECT,values)
+        row = cursor.fetchone()
+        conn.commit()
+      finally:
+        conn.close()
+    elif config["method"] == "pool":
+      row = writerRequest(config,CONST_INSERTSELECT,values,"one")["rows"][0]
+    elif config["method"] == "ssh_tunnel":
+      conn = tunnelConnection(config)
+      with conn:
+        cursor = conn.cursor()
+        cursor.execute(CONST_INSERTSELECT,values)
+        row = cursor.fetchone()
+    else:
+      raise Exception("Unsupported method: "+str(config["method"]))
+    if row is not None:
+      # numeric columns come back as Decimal, which exit_json cannot serialize.
+      row = dict(zip(["time", "autid", "autotime", "svtime", "transactionid", "ticketid", "svfte"],
+                     [float(v) if isinstance(v, Decimal) else str(v) if isinstance(v, date) else v for v in row]))
+  if row is None:
+    GLOBAL_MESSAGE += "Record with aut_id = "+str(data["aut_id"])+" does NOT exist in catalog OR the calculated svtime is negative"
+    GLOBAL_ERRORS += 1
+  return row
+
 def insertData(config,data):
   global GLOBAL_MESSAGE
   global GLOBAL_ERRORS
   # Calculate variables to be inserted
   try:
-    now = datetime.now()
-    time = now.strftime("%Y-%m-%d %H:%M:%S")
-    endtime = now.strftime('%s')
-    autotime =  (int(endtime)//1 - int(data["playbook_start_timestamp"])//1)/3600
+    if "port" not in config.keys():
+      config["port"] = 5432
+    if config.get("server_side") and config["method"] != "spool":
+      return insertServerSide(config,data)
     mantime = getManTime(config,data["aut_id"])
-    svtime = mantime - autotime
-    svfte = svtime/150
-    if autotime < 0 or svtime < 0:
-      raise Exception("Exception: autotime or svtime or both are negative numbers.")
-    transactionid = data["transaction_identifier"]+"."+now.strftime("%Y%m%d.%H%M%S.%f")
+    values = calculateRow(data,datetime.now(),mantime)
     if "port" not in config.keys():
       config["port"] = 5432
     if config["method"] == "ssh":
-      query = "insert into indicadores (time, autid, autotime, svtime, transactionid, ticketid, svfte) values "
-      values = "('"+time+"',"+str(data["aut_id"])+","+str(autotime)+","+str(svtime)+",'"+transactionid+"','"+data["woid"]+"',"+str(svfte)+");"
-      completequery = query+values
+      completequery = CONST_INSERT+" values ("+",".join([sqlLiteral(v) for v in values])+");"
       completecommand = "PGPASSWORD=\""+config["db_password"]+"\" psql -h "+config["db_server"]+" -U "+config["db_user"]+" -d "+config["db_name"]+" -p "+str(config["db_port"])+" -c \""+completequery+"\""
       p = paramiko.SSHClient()
       p.set_missing_host_key_policy(paramiko.AutoAddPolicy())   # This script doesn't work for me unless this line is added!
@@ -182,20 +526,170 @@ def insertData(config,data):
         GLOBAL_ERRORS += 1
     elif config["method"] == "postgres":
       conn = psycopg2.connect(dbname=config["db_name"], user=config["db_user"], password=config["db_password"], host=config["db_server"],port=config["db_port"])
+      try:
+        cursor = conn.cursor()
+        cursor.execute(CONST_INSERT+" values (%s, %s, %s, %s, %s, %s, %s)",values)
+        conn.commit()
+      finally:
+        conn.close()
+    elif config["method"] == "pool":
+      writerRequest(config,CONST_INSERT+" values (%s, %s, %s, %s, %s, %s, %s)",values)
+    elif config["method"] == "ssh_tunnel":
+      conn = tunnelConnection(config)
+      with conn:
+        conn.cursor().execute(CONST_INSERT+" values (%s, %s, %s, %s, %s, %s, %s)",values)
+    elif config["method"] == "spool":
+      spoolRows(config,[values])
+  except Exception as e:
+    GLOBAL_MESSAGE += str(e)
+    GLOBAL_ERRORS += 1
+
+def spoolDestination(config):
+  # The database a spooled row is meant for; indicadores_writer.py only
+  # flushes the rows of the database in its own --config.
+  return str(config["db_server"])+":"+(str(config.get("db_port", "")).strip() or "5432")+"/"+str(config["db_name"])
+
+def spoolRows(config,rows):
+  # Appends rows to the local spool that indicadores_writer.py drains into
+  # the database. WAL keeps the spool consistent if a fork dies mid-write.
+  columns = [c.strip() for c in CONST_COLUMNS.split(",")]
+  conn = sqlite3.connect(statePath(config, "spool_file", CONST_SPOOLFILE), timeout=30)
+  try:
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(CONST_SPOOLSCHEMA)
+    if "destination" not in [c[1] for c in conn.execute("PRAGMA table_info(spool)")]:
+      # Spool created before rows recorded their database.
+      try:
+        conn.execute("ALTER TABLE spool ADD COLUMN destination TEXT NOT NULL DEFAULT ''")
+      except sqlite3.OperationalError:
+        pass
+    destination = spoolDestination(config)
+    with conn:
+      conn.executemany("INSERT INTO spool (target, columns, transactionid, row, created, destination) VALUES (?, ?, ?, ?, ?, ?)",
+                       [(CONST_TABLE, ",".join(columns), row[columns.index("transactionid")], json.dumps(row), time.time(), destination) for row in rows])
+  finally:
+    conn.close()
+
+def loadRows(config,rows):
+  # Loads all rows in one transaction, config.chunk_size rows per multi-row
+  # INSERT.
+  chunksize = int(config.get("chunk_size", CONST_CHUNKSIZE))
+  if "port" not in config.keys():
+    config["port"] = 5432
+  if config["method"] == "ssh":
+    statements = [CONST_INSERT+" values "+",".join(["("+",".join([sqlLiteral(v) for v in row])+")" for row in rows[i:i+chunksize]])+";" for i in range(0, len(rows), chunksize)]
+    # The statements go through psql's stdin, which has no length limit,
+    # and -1 wraps them in a single transaction.
+    completecommand = "PGPASSWORD=\""+config["db_password"]+"\" psql -1 -v ON_ERROR_STOP=1 -h "+config["db_server"]+" -U "+config["db_user"]+" -d "+config["db_name"]+" -p "+str(config["db_port"])+" -f -"
+    p = paramiko.SSHClient()
+    p.set_missing_host_key_policy(paramiko.AutoAddPolicy())   # This script doesn't work for me unless this line is added!
+    p.connect(config["ssh_server"], port=config["ssh_port"], username=config["ssh_user"], password=config["ssh_password"])
+    try:
+      stdin, stdout, stderr = p.exec_command(completecommand)
+      stdin.write("\n".join(statements)+"\n")
+      stdin.channel.shutdown_write()
+      opt = "".join(stdout.readlines())
+      err = "".join(stderr.readlines())
+      if stdout.channel.recv_exit_status() != 0:
+        raise Exception("POSTGRESQL ERROR: stdout: "+opt+"; stderr: "+err)
+    finally:
+      p.close()
+  elif config["method"] == "postgres":
+    conn = psycopg2.connect(dbname=config["db_name"], user=config["db_user"], password=config["db_password"], host=config["db_server"],port=config["db_port"])
+    try:
       cursor = conn.cursor()
-      query = "insert into indicadores (time, autid, autotime, svtime, transactionid, ticketid, svfte) values (%s, %s, %s, %s, %s, %s, %s)"
-      values = [time,data["aut_id"],autotime,svtime,transactionid,data["woid"],svfte]
-      cursor.execute(query,values)
+      psycopg2.extras.execute_values(cursor, CONST_INSERT+" values %s", rows, page_size=chunksize)
       conn.commit()
+    finally:
+      conn.close()
+  elif config["method"] == "pool":
+    writerRequest(config,CONST_INSERT+" values %s",None,rows=rows,pagesize=chunksize)
+  elif config["method"] == "ssh_tunnel":
+    conn = tunnelConnection(config)
+    with conn:
+      psycopg2.extras.execute_values(conn.cursor(), CONST_INSERT+" values %s", rows, page_size=chunksize)
+  elif config["method"] == "spool":
+    spoolRows(config,rows)
+  else:
+    raise Exception("Unsupported method for records: "+str(config["method"]))
+
+def insertRecords(config,records):
+  global GLOBAL_MESSAGE
+  global GLOBAL_ERRORS
+  # Every record is validated and calculated before anything is sent; the
+  # ones that fail are rejected with their own messages and the rest are
+  # loaded together. The catalog is read once per distinct aut_id.
+  # Returns (inserted, rejected).
+  now = datetime.now()
+  mantimes = {}
+  rows = []
+  rejected = []
+  for index, record in enumerate(records):
+    message, errors = GLOBAL_MESSAGE, GLOBAL_ERRORS
+    GLOBAL_MESSAGE, GLOBAL_ERRORS = "", 0
+    try:
+      record = validateData(dict(record))
+      if GLOBAL_ERRORS == 0:
+        autid = str(record["aut_id"])
+        if autid not in mantimes:
+          mantimes[autid] = getManTime(config,record["aut_id"])
+        if mantimes[autid] is None:
+          if GLOBAL_ERRORS == 0:
+            GLOBAL_MESSAGE += "Record with aut_id = "+autid+" does NOT exist in catalog OR returned an invalid 'mantime' value"
+            GLOBAL_ERRORS += 1
+        else:
+          # One microsecond apart so every record gets its own transactionid.
+          row = calculateRow(record,now+timedelta(microseconds=index),mantimes[autid])
+    except Exception as e:
+      GLOBAL_MESSAGE += str(e)
+      GLOBAL_ERRORS += 1
+    if GLOBAL_ERRORS > 0:
+      rejected.append({"index": index, "error": GLOBAL_MESSAGE.strip()})
+    else:
+      rows.append(row)
+    GLOBAL_MESSAGE, GLOBAL_ERRORS = message, errors
+  if not rows:
+    return 0, rejected
+  try:
+    loadRows(config,rows)
   except Exception as e:
     GLOBAL_MESSAGE += str(e)
     GLOBAL_ERRORS += 1
+    return 0, rejected
+  return len(rows), rejected
   
     
 
 # Module constants definition
 GLOBAL_MESSAGE = ""
 GLOBAL_ERRORS = 0
+CONST_STATEDIR = "~/.indicadores"
+CONST_WRITERSOCKET = "writer.sock"
+CONST_SPOOLFILE = "spool.db"
+# Same table as in indicadores_writer.py, which drains the spool; spoolRows and
+# spoolDestination are repeated in db_indicadores.py and indicadores.py. Keep
+# the schema, the destination migration and the key in step across the three.
+CONST_SPOOLSCHEMA = ("CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, target TEXT NOT NULL, "
+                     "columns TEXT NOT NULL, transactionid TEXT NOT NULL, row TEXT NOT NULL, created REAL NOT NULL, "
+                     "destination TEXT NOT NULL DEFAULT '')")
+TUNNEL_CLIENT = None
+TUNNEL_DIR = None
+TUNNEL_CONN = None
+TUNNEL_LOCK = threading.Lock()
+CATALOG = None
+CATALOG_FETCHED = False
+CONST_CATALOGFILE = "catalog_%s.json"
+CONST_CATALOGTTL = 3600
+CONST_CATALOGMINAGE = 60
+CONST_CHUNKSIZE = 500
+CONST_TABLE = "indicadores"
+CONST_COLUMNS = "time, autid, autotime, svtime, transactionid, ticketid, svfte"
+CONST_INSERT = "insert into "+CONST_TABLE+" ("+CONST_COLUMNS+")"
+CONST_INSERTSELECT = (CONST_INSERT+" select %(time)s, a.id, v.autotime, a.mantime - v.autotime, %(transactionid)s, %(ticketid)s, (a.mantime - v.autotime)/150"
+  " from automatizacion a, (select cast(%(autotime)s as double precision) as autotime) v"
+  " where a.id = %(autid)s and a.mantime - v.autotime >= 0"
+  " returning time, autid, autotime, svtime, transactionid, ticketid, svfte")
 CONST_REQUIRED = ["aut_id", "playbook_start_timestamp"]
 CONST_DEFAULTS = {
     "transaction_identifier" : "XXX",
@@ -217,7 +711,8 @@ def run_module():
     # define available arguments/parameters a user can pass to the module
     module_args = dict(
         config=dict(type='dict',required=True, no_log=True),
-        data=dict(type='dict', required=True)
+        data=dict(type='dict', required=False),
+        records=dict(type='list', elements='dict', required=False)
     )
 
     # seed the result dict in the object
@@ -237,6 +732,8 @@ def run_module():
     # supports check mode
     module = AnsibleModule(
         argument_spec=module_args,
+        required_one_of=[('data', 'records')],
+        mutually_exclusive=[('data', 'records')],
         supports_check_mode=False
     )
 
@@ -252,15 +749,41 @@ def run_module():
     result['original_message'] = "Requested create record in database'"
     
     # made any modifications to your target
+    if module.params["records"] is not None:
+      # Records are loaded in one go; the ones that do not validate are
+      # reported in errors and do not stop the others.
+      try:
+        inserted, rejected = insertRecords(module.params["config"],module.params["records"])
+        error = GLOBAL_MESSAGE
+      except Exception as e:
+        inserted, rejected = 0, []
+        error = GLOBAL_MESSAGE+str(e)
+      result["inserted"] = inserted
+      result["rejected"] = len(rejected)
+      result["errors"] = rejected
+      if inserted == 0:
+        result["message"] = "ERROR: Could not insert records into database."
+        module.fail_json(msg=error or "No valid records to insert", **result)
+      if module.params["config"].get("method") == "spool":
+        result["message"] = "SUCCESSFULLY spooled "+str(inserted)+" of "+str(len(module.params["records"]))+" records for the database"
+      else:
+        result["message"] = "SUCCESSFULLY inserted "+str(inserted)+" of "+str(len(module.params["records"]))+" records into database"
+      result["changed"] = True
+      module.exit_json(**result)
     try:
       validatedData = validateData(module.params["data"])
       #print("Data validated, inserting data...")
-      insertData(module.params["config"],validatedData)
+      record = insertData(module.params["config"],validatedData)
+      if record is not None:
+        result["record"] = record
       if GLOBAL_ERRORS > 0:
         result["message"] = "ERROR: Could not insert data into database."
         module.fail_json(msg=GLOBAL_MESSAGE, **result)
       else:
-        result["message"] = "SUCCESSFULLY inserted data into database"
+        if module.params["config"].get("method") == "spool":
+          result["message"] = "SUCCESSFULLY spooled data for the database"
+        else:
+          result["message"] = "SUCCESSFULLY inserted data into database"
         result["changed"] = True
         module.exit_json(**result)
     except Exception as e:
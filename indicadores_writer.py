@@ -0,0 +1,431 @@
+#!/usr/bin/python
+
+# Local writer service for db_indicadores.py and indicadores.py. It keeps a
+# bounded psycopg2 connection pool to the indicadores database and runs the
+# statements the modules send over a Unix socket (config.method: pool), so
+# hundreds of forks finishing together share a few connections instead of
+# opening one each.
+#
+#   python indicadores_writer.py --config /etc/indicadores_db.json --max 5
+#
+# The socket, like the modules' spool and catalog cache, lives in a private
+# state directory (~/.indicadores, mode 0700; config.state_dir in the
+# modules, --state-dir here) rather than in /tmp. Run the writer as the
+# user the modules run as.
+#
+# The config file holds the same db_* keys as the modules' config option.
+# With ssh_server, ssh_port, ssh_user and ssh_password in it too, the pool
+# connects through one SSH transport forwarding to db_server:db_port, so
+# every task of every run shares a single SSH session to the database host.
+# Requests and replies are one JSON line each:
+#   {"query": "insert ...", "values": [...], "fetch": null | "one" | "all"}
+#   {"query": "insert ... values %s", "rows": [[...], ...], "page_size": 500}
+#   {"rowcount": 1, "rows": [...]} or {"error": "..."}
+#
+# With --spool it also drains the SQLite spool the modules fill with
+# config.method: spool, every --flush-interval seconds while serving, or
+# once with --flush. Only the rows spooled for the database in --config are
+# flushed. Rows the database rejects (bad data, constraint violations) are
+# moved to the spool_failed table with the error instead of blocking the
+# spool. --spool-status prints the spool depth, the age of its oldest row,
+# the depth per database and the number of failed rows.
+#
+#   python indicadores_writer.py --config /etc/indicadores_db.json --spool ~/.indicadores/spool.db --flush
+#   python indicadores_writer.py --spool ~/.indicadores/spool.db --spool-status
+from __future__ import (absolute_import, division, print_function)
+import argparse
+import atexit
+import csv
+import fcntl
+import io
+import json
+import os
+import select
+import shutil
+import socket
+import socketserver
+import sqlite3
+import sys
+import tempfile
+import threading
+from time import time
+
+import psycopg2
+import psycopg2.extras
+import psycopg2.pool
+import paramiko
+
+CONST_STATEDIR = "~/.indicadores"
+CONST_SOCKET = "writer.sock"
+# The spool table and its destination migration are repeated in spoolRows of
+# db_indicadores.py and indicadores.py, which create the spool when they fill
+# it; keep the three in step.
+CONST_SPOOLSCHEMA = ("CREATE TABLE IF NOT EXISTS spool (id INTEGER PRIMARY KEY AUTOINCREMENT, target TEXT NOT NULL, "
+                     "columns TEXT NOT NULL, transactionid TEXT NOT NULL, row TEXT NOT NULL, created REAL NOT NULL, "
+                     "destination TEXT NOT NULL DEFAULT '')")
+CONST_FAILEDSCHEMA = ("CREATE TABLE IF NOT EXISTS spool_failed (id INTEGER PRIMARY KEY, target TEXT NOT NULL, columns TEXT NOT NULL, "
+                      "transactionid TEXT NOT NULL, row TEXT NOT NULL, created REAL NOT NULL, destination TEXT NOT NULL, "
+                      "error TEXT NOT NULL, failed REAL NOT NULL)")
+POOL = None
+POOL_SLOTS = None
+LASTREQUEST = 0
+TUNNEL_CLIENT = None
+TUNNEL_DIR = None
+TUNNEL_LOCK = threading.Lock()
+
+
+# sshTransport, forwardChannel and openTunnel are the same in db_indicadores.py,
+# indicadores.py and indicadores_writer.py. Each module has to run as a single
+# file, so there is no shared module_utils; change all three copies together.
+def sshTransport(config):
+  global TUNNEL_CLIENT
+  # One SSH transport for every forwarded connection, reopened if it drops.
+  with TUNNEL_LOCK:
+    if TUNNEL_CLIENT is None or TUNNEL_CLIENT.get_transport() is None or not TUNNEL_CLIENT.get_transport().is_active():
+      p = paramiko.SSHClient()
+      p.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+      p.connect(config["ssh_server"], port=int(config.get("ssh_port", 22)), username=config["ssh_user"], password=config["ssh_password"])
+      p.get_transport().set_keepalive(30)
+      TUNNEL_CLIENT = p
+    return TUNNEL_CLIENT.get_transport()
+
+
+def forwardChannel(config,sock):
+  try:
+    chan = sshTransport(config).open_channel("direct-tcpip", (config["db_server"], int(config.get("db_port", 5432))), ("127.0.0.1", 0))
+  except Exception:
+    sock.close()
+    return
+  try:
+    while True:
+      readable, _, _ = select.select([sock, chan], [], [])
+      if sock in readable:
+        chunk = sock.recv(65536)
+        if not chunk:
+          break
+        chan.sendall(chunk)
+      if chan in readable:
+        chunk = chan.recv(65536)
+        if not chunk:
+          break
+        sock.sendall(chunk)
+  finally:
+    chan.close()
+    sock.close()
+
+
+def openTunnel(config):
+  global TUNNEL_DIR
+  # Returns the host and port psycopg2 connects to for db_server:db_port
+  # through the SSH server. The listener is a Unix socket named the way libpq
+  # expects (.s.PGSQL.<port>) in a fresh 0700 directory, so other local users
+  # cannot use it as a relay to the database the way they could a TCP port.
+  port = int(str(config.get("db_port", "")).strip() or 5432)
+  if TUNNEL_DIR is None:
+    sshTransport(config)
+    path = tempfile.mkdtemp(prefix="tunnel_", dir=statedir(config.get("state_dir") or CONST_STATEDIR))
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(os.path.join(path, ".s.PGSQL."+str(port)))
+    listener.listen(16)
+    atexit.register(closeTunnel, listener, path)
+    def accept():
+      while True:
+        sock, _ = listener.accept()
+        threading.Thread(target=forwardChannel, args=(config, sock), daemon=True).start()
+    threading.Thread(target=accept, daemon=True).start()
+    TUNNEL_DIR = path
+  return TUNNEL_DIR, port
+
+
+def closeTunnel(listener,path):
+  listener.close()
+  shutil.rmtree(path, ignore_errors=True)
+
+
+def execute(request):
+  # Runs one statement on a pooled connection in its own transaction. A
+  # connection that turns out to be broken is dropped from the pool and the
+  # statement is tried once more on a fresh one.
+  for attempt in range(2):
+    with POOL_SLOTS:
+      conn = POOL.getconn()
+      broken = False
+      try:
+        with conn:
+          with conn.cursor() as cursor:
+            if request.get("rows") is not None:
+              # Multi-row load: all pages in the same transaction.
+              psycopg2.extras.execute_values(cursor, request["query"], request["rows"], page_size=request.get("page_size") or 100)
+              reply = {'rowcount': len(request["rows"])}
+            else:
+              cursor.execute(request["query"], request.get("values"))
+              reply = {'rowcount': cursor.rowcount}
+            if request.get("fetch") == "one":
+              reply["rows"] = [cursor.fetchone()]
+            elif request.get("fetch") == "all":
+              reply["rows"] = cursor.fetchall()
+        return reply
+      except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+        broken = True
+        if attempt == 1:
+          return {'error': str(e)}
+      except Exception as e:
+        return {'error': str(e)}
+      finally:
+        POOL.putconn(conn, close=broken or conn.closed != 0)
+
+
+def statedir(path):
+  # Same checks as the modules' stateDir: a 0700 directory of this user, not
+  # /tmp, where any local user could create the spool or socket first.
+  path = os.path.expanduser(path)
+  if not os.path.isdir(path):
+    os.makedirs(path, 0o700, exist_ok=True)
+  st = os.stat(path)
+  if st.st_uid != os.getuid() or st.st_mode & 0o077:
+    raise Exception("Refusing state directory "+path+": it must be owned by the current user and mode 0700")
+  return path
+
+
+def ownedpath(path):
+  # Refuses an existing file another user owns or may write to, or a symlink.
+  if os.path.lexists(path):
+    st = os.lstat(path)
+    if os.path.islink(path) or st.st_uid != os.getuid() or st.st_mode & 0o022:
+      raise Exception("Refusing "+path+": it must be a file owned by the current user and not writable by others")
+  return path
+
+
+def spool(path):
+  conn = sqlite3.connect(ownedpath(os.path.expanduser(path)), timeout=30)
+  conn.execute("PRAGMA journal_mode=WAL")
+  conn.execute(CONST_SPOOLSCHEMA)
+  conn.execute(CONST_FAILEDSCHEMA)
+  if "destination" not in [c[1] for c in conn.execute("PRAGMA table_info(spool)")]:
+    # Spool created before rows recorded their database.
+    try:
+      conn.execute("ALTER TABLE spool ADD COLUMN destination TEXT NOT NULL DEFAULT ''")
+    except sqlite3.OperationalError:
+      pass
+  return conn
+
+
+def spooldestination(config):
+  # Same key the modules store with each spooled row (spoolDestination).
+  return str(config["db_server"])+":"+(str(config.get("db_port", "")).strip() or "5432")+"/"+str(config["db_name"])
+
+
+def spoolstatus(path):
+  conn = spool(path)
+  try:
+    depth, oldest = conn.execute("SELECT COUNT(*), MIN(created) FROM spool").fetchone()
+    destinations = dict(conn.execute("SELECT destination, COUNT(*) FROM spool GROUP BY destination").fetchall())
+    failed, lasterror = conn.execute("SELECT COUNT(*), (SELECT error FROM spool_failed ORDER BY failed DESC LIMIT 1) FROM spool_failed").fetchone()
+  finally:
+    conn.close()
+  return {'depth': depth, 'oldest_age': round(time() - oldest, 1) if oldest else 0, 'destinations': destinations,
+          'failed': failed, 'last_error': lasterror}
+
+
+def copyrows(cursor, target, columns, rows):
+  # COPY into a temporary table, then insert the rows whose transactionid is
+  # not in the target yet, so a batch sent twice (a crash between the commit
+  # here and the spool delete) is not loaded twice. The lookup is bounded to
+  # the batch's time range so the hypertable only scans the matching chunks.
+  buffer = io.StringIO()
+  csv.writer(buffer).writerows(rows)
+  buffer.seek(0)
+  cursor.execute("CREATE TEMP TABLE spool_load (LIKE "+target+" INCLUDING DEFAULTS) ON COMMIT DROP")
+  cursor.copy_expert("COPY spool_load ("+columns+") FROM STDIN WITH (FORMAT csv)", buffer)
+  cursor.execute("INSERT INTO "+target+" ("+columns+") SELECT DISTINCT ON (transactionid) "+columns+" FROM spool_load s "
+                 "WHERE NOT EXISTS (SELECT 1 FROM "+target+" t WHERE t.transactionid = s.transactionid "
+                 "AND t.time >= (SELECT min(time) FROM spool_load))")
+  inserted = cursor.rowcount
+  # Dropped now as a batch may hold rows of both modules' column sets.
+  cursor.execute("DROP TABLE spool_load")
+  return inserted
+
+
+def loadbatch(rows):
+  # Loads spool rows in one transaction. Returns (inserted, duplicates).
+  batches = {}
+  for rowid, target, columns, row in rows:
+    batches.setdefault((target, columns), []).append(json.loads(row))
+  inserted = 0
+  duplicates = 0
+  with POOL_SLOTS:
+    db = POOL.getconn()
+    try:
+      with db:
+        with db.cursor() as cursor:
+          for (target, columns), batch in batches.items():
+            loaded = copyrows(cursor, target, columns, batch)
+            inserted += loaded
+            duplicates += len(batch) - loaded
+    finally:
+      POOL.putconn(db, close=db.closed != 0)
+  return inserted, duplicates
+
+
+def loadrows(rows, rejected):
+  # A batch the database rejects for its data is split in halves until the
+  # offending rows are alone; those are appended to rejected as (id, error)
+  # and every other row is loaded.
+  try:
+    return loadbatch(rows)
+  except (psycopg2.DataError, psycopg2.IntegrityError, ValueError) as e:
+    if len(rows) == 1:
+      rejected.append((rows[0][0], str(e).strip()))
+      return 0, 0
+    half = len(rows) // 2
+    first = loadrows(rows[:half], rejected)
+    second = loadrows(rows[half:], rejected)
+    return first[0] + second[0], first[1] + second[1]
+
+
+def flushspool(path, batchsize, destination):
+  # Drains the rows spooled for destination oldest first, batchsize rows per
+  # transaction. Rows are deleted from the spool only after their batch is
+  # committed. Rows spooled before rows recorded a destination ('') are
+  # taken as this writer's. Rows the database rejects are moved to
+  # spool_failed so they do not hold up the rows behind them.
+  lock = open(path + ".flush.lock", 'a')
+  try:
+    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except (IOError, OSError):
+    lock.close()
+    return {'flushed': 0, 'duplicates': 0, 'failed': 0, 'running': True}
+  conn = spool(path)
+  flushed = 0
+  duplicates = 0
+  failed = 0
+  try:
+    while True:
+      rows = conn.execute("SELECT id, target, columns, row FROM spool WHERE destination IN (?, '') ORDER BY id LIMIT ?",
+                          (destination, batchsize)).fetchall()
+      if not rows:
+        break
+      rejected = []
+      inserted, skipped = loadrows(rows, rejected)
+      flushed += inserted
+      duplicates += skipped
+      failed += len(rejected)
+      with conn:
+        conn.executemany("INSERT INTO spool_failed (id, target, columns, transactionid, row, created, destination, error, failed) "
+                         "SELECT id, target, columns, transactionid, row, created, destination, ?, ? FROM spool WHERE id = ?",
+                         [(error, time(), rowid) for rowid, error in rejected])
+        conn.executemany("DELETE FROM spool WHERE id = ?", [(row[0],) for row in rows])
+  finally:
+    conn.close()
+    fcntl.flock(lock, fcntl.LOCK_UN)
+    lock.close()
+  return {'flushed': flushed, 'duplicates': duplicates, 'failed': failed}
+
+
+class WriterHandler(socketserver.StreamRequestHandler):
+
+  def handle(self):
+    global LASTREQUEST
+    for line in self.rfile:
+      LASTREQUEST = time()
+      try:
+        reply = execute(json.loads(line.decode()))
+      except Exception as e:
+        reply = {'error': str(e)}
+      self.wfile.write((json.dumps(reply, default=str) + "\n").encode())
+      self.wfile.flush()
+
+
+def flusher(spoolpath, flushinterval, batchsize, destination, stop):
+  # Flushes the spool every flushinterval seconds on its own thread, so a
+  # long flush does not hold up the requests on the socket.
+  while True:
+    try:
+      result = flushspool(spoolpath, batchsize, destination)
+      if result['failed']:
+        sys.stderr.write("Spool flush moved "+str(result['failed'])+" rejected rows to spool_failed\n")
+    except Exception as e:
+      sys.stderr.write("Spool flush failed: "+str(e)+"\n")
+    if stop.wait(flushinterval):
+      break
+
+
+def serve(socketpath, idletimeout, spoolpath=None, flushinterval=60, batchsize=5000, destination=None):
+  global LASTREQUEST
+  if os.path.exists(socketpath):
+    os.remove(socketpath)
+  server = socketserver.ThreadingUnixStreamServer(socketpath, WriterHandler)
+  server.daemon_threads = True
+  os.chmod(socketpath, 0o600)
+  inode = os.stat(socketpath).st_ino
+  LASTREQUEST = time()
+  server.timeout = 5
+  stop = threading.Event()
+  flush = None
+  if spoolpath:
+    flush = threading.Thread(target=flusher, args=(spoolpath, flushinterval, batchsize, destination, stop))
+    flush.start()
+  try:
+    while idletimeout <= 0 or time() - LASTREQUEST < idletimeout:
+      server.handle_request()
+  finally:
+    server.server_close()
+    # A writer started after this one may already own the path.
+    if os.path.exists(socketpath) and os.stat(socketpath).st_ino == inode:
+      os.remove(socketpath)
+    # Let a flush in progress commit before the pool goes away.
+    stop.set()
+    if flush is not None:
+      flush.join()
+    POOL.closeall()
+
+
+def main():
+  global POOL
+  global POOL_SLOTS
+  parser = argparse.ArgumentParser(description="Pooled database writer for the indicadores modules")
+  parser.add_argument('--config', help="JSON file with db_name, db_user, db_password, db_server and db_port")
+  parser.add_argument('--state-dir', default=CONST_STATEDIR, help="private directory holding the socket (default ~/.indicadores)")
+  parser.add_argument('--socket', help="Unix socket to listen on (default <state-dir>/"+CONST_SOCKET+")")
+  parser.add_argument('--min', type=int, default=1, help="connections opened at start")
+  parser.add_argument('--max', type=int, default=5, help="connections the pool may hold")
+  parser.add_argument('--idle-timeout', type=int, default=0, help="exit after this many idle seconds (0 = never)")
+  parser.add_argument('--spool', help="SQLite spool filled by config.method: spool")
+  parser.add_argument('--flush-interval', type=int, default=60, help="seconds between spool flushes while serving")
+  parser.add_argument('--batch-size', type=int, default=5000, help="spool rows per COPY transaction")
+  parser.add_argument('--flush', action='store_true', help="flush the spool once and exit")
+  parser.add_argument('--spool-status', action='store_true', help="print the spool depth and age and exit")
+  args = parser.parse_args()
+  if (args.flush or args.spool_status) and not args.spool:
+    parser.error("--spool is required with --flush and --spool-status")
+  if args.spool_status:
+    print(json.dumps(spoolstatus(args.spool)))
+    return 0
+  if not args.config:
+    parser.error("--config is required")
+  with open(args.config, 'r') as file:
+    config = json.load(file)
+  if "db_port" not in config.keys() or not str(config["db_port"]).strip():
+    config["db_port"] = 5432
+  host, port = config["db_server"], config["db_port"]
+  if config.get("ssh_server"):
+    config["state_dir"] = args.state_dir
+    host, port = openTunnel(config)
+  POOL = psycopg2.pool.ThreadedConnectionPool(args.min, args.max, dbname=config["db_name"], user=config["db_user"],
+                                              password=config["db_password"], host=host, port=port)
+  # ThreadedConnectionPool raises instead of waiting when all connections
+  # are in use, so requests queue on a semaphore of the same size.
+  POOL_SLOTS = threading.BoundedSemaphore(args.max)
+  if args.flush:
+    try:
+      result = flushspool(args.spool, args.batch_size, spooldestination(config))
+      result.update(spoolstatus(args.spool))
+      print(json.dumps(result))
+    finally:
+      POOL.closeall()
+    return 0
+  serve(args.socket or os.path.join(statedir(args.state_dir), CONST_SOCKET), args.idle_timeout, args.spool, args.flush_interval, args.batch_size, spooldestination(config))
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -6,19 +6,35 @@ from __future__ import (absolute_import, division, print_function)
 from ansible.module_utils.basic import AnsibleModule
 import filelock
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import base64
 import os
 from os import path
-from time import sleep
-import http.client
-import ssl
-import chardet
+from time import sleep, time
+import socket
+import socketserver
+import subprocess
+import threading
+import asyncio
+import sqlite3
+import hashlib
+import glob
+import copy
+from contextlib import contextmanager
+import inspect
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import mimetypes
 import sys
 import logging
 from logging import getLogger, INFO
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
 from concurrent_log_handler import ConcurrentRotatingFileHandler
-from datetime import datetime
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import random
 
 # These two lines enable debugging at httplib level (requests->urllib3->http.client)
 # You will see the REQUEST, including HEADERS and DATA, and RESPONSE with HEADERS but without DATA.
@@ -91,256 +107,1527 @@ message:
 
 
 # Module constants definitionwrite to syslog
-CONST_NUMRETRIES = 3
-CONST_TOKENFILE=""
+TOKEN_CACHE = {}
+TOKEN_USED = threading.local()
+REFRESH_LOCK = threading.Lock()
+ENTRYID_CACHE = {}
 CONST_LOGIN = '/api/jwt/login'
 CONST_API = '/api/arsys/v1/entry'
 CONST_LOGOUT = '/api/jwt/logout'
 CONST_CREATEWO = '/WOI:WorkOrderInterface_Create'
 CONST_MODIFY = '/WOI:WorkOrder'
 CONST_ATTACHMENT = '/WOI:WorkInfo'
-CONST_MESSAGE = ""
-LOG = False
+CONST_WORKFLOWACTIONS = ['create', 'modify', 'add_attachment']
+CONST_STEPFIELDS = ['action', 'data', 'woid', 'filename', 'filenames']
+CONST_OUTBOXACTIONS = ['create', 'create_batch', 'modify', 'modify_bulk', 'add_attachment', 'workflow']
+CONST_OUTBOXFIELDS = ['action', 'data', 'woid', 'filename', 'filenames', 'items', 'steps']
+CONST_POOLSIZE = 10
+CONST_CHUNKSIZE = 1024*1024
+SESSION = None
 LOG_HANDLER = None
-LOG_ID = None
+LOG_FILE = None
+LOG_MODE = None
+LOG_LISTENER = None
+LOG_BUFFER = None
+LOG_LOCK = threading.RLock()
+REQUEST = threading.local()
+GATEWAY_LASTREQUEST = 0
+GATEWAY_ACTIVE = 0
+GATEWAY_LOCK = threading.Lock()
+GATEWAY_OUTBOX = None
+GATEWAY_WAKE = threading.Event()
+GATEWAY_SLOTS = None
+CIRCUIT_LOCK = threading.RLock()
+TIMINGS_LOCK = threading.Lock()
+
+
+class RequestState(object):
+    # Settings and scratch state of one module run. setup() starts a new one
+    # per run; the gateway serves runs on several threads at once, so this
+    # lives behind the thread-local REQUEST instead of in module globals.
+    def __init__(self):
+        self.message = ""
+        self.tokenfile = ""
+        self.tokenmargin = 60
+        self.user = ""
+        self.password = ""
+        self.numretries = 3
+        self.retrydelay = 1
+        self.retrymaxdelay = 30
+        self.timeout = (10, 300)
+        self.locktimeout = 60
+        self.entryidcachesize = 1000
+        self.resolvechunk = 100
+        self.entryvalues = {}
+        self.onlychanged = True
+        self.circuitthreshold = 5
+        self.circuitcooldown = 60
+        self.circuitdirty = False
+        self.circuitprobe = False
+        self.transient = False
+        self.log = False
+        self.logid = None
+        self.logcontext = {}
+        self.timings = {}
+        self.timingsstart = time()
+
+
+def request():
+  state = getattr(REQUEST, 'state', None)
+  if state is None:
+      state = REQUEST.state = RequestState()
+  return state
+
+def inrequest(call):
+  # Binds call to the run of the calling thread, for the worker threads an
+  # action starts.
+  state = request()
+  def bound(*args, **kwargs):
+      REQUEST.state = state
+      return call(*args, **kwargs)
+  return bound
 
 def log(message):
-  global LOG
   global LOG_HANDLER
-  global LOG_ID
-  if LOG:
+  state = request()
+  if state.log:
     try:
-        LOG_HANDLER.info(LOG_ID+": "+str(datetime.now())+": "+message)
+        if LOG_MODE == "queue":
+            LOG_HANDLER.info(json.dumps({
+                'time': datetime.now().isoformat(),
+                'log_identifier': state.logid,
+                'action': state.logcontext.get('action'),
+                'woid': state.logcontext.get('woid'),
+                'elapsed': round(time() - state.logcontext.get('start', time()), 3),
+                'message': message
+            }))
+        else:
+            LOG_HANDLER.info(state.logid+": "+str(datetime.now())+": "+message)
     except Exception as e:
         pass
 
+
+class BufferedLogHandler(logging.Handler):
+    # Keeps the formatted records of a run in memory and hands them to the
+    # target handler as one record on flush, so ConcurrentRotatingFileHandler
+    # takes its inter-process lock once per run instead of once per record.
+    def __init__(self, target):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(self.format(record))
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.lines:
+                record = logging.LogRecord(__name__, INFO, __file__, 0, "\n".join(self.lines), None, None)
+                self.lines = []
+                self.target.handle(record)
+        finally:
+            self.release()
+
+
+def stoplog():
+  # Drains the log queue and writes the buffered records. Registered with
+  # atexit, so it also runs when exit_json/fail_json end the module.
+  global LOG_LISTENER
+  if LOG_LISTENER is not None:
+      LOG_LISTENER.stop()
+      LOG_BUFFER.flush()
+      LOG_LISTENER = None
+
+def flushlog():
+  with LOG_LOCK:
+      if LOG_LISTENER is not None:
+          LOG_LISTENER.stop()
+          LOG_BUFFER.flush()
+          LOG_LISTENER.start()
+
+@contextmanager
+def timed(phase):
+  start = time()
+  try:
+      yield
+  finally:
+      addtiming(phase, time() - start)
+
+def addtiming(phase, seconds, nbytes=None):
+  # Wall-clock time and call count per phase of the current run, reported in
+  # the result when the timings option is set.
+  with TIMINGS_LOCK:
+      entry = request().timings.setdefault(phase, {'seconds': 0.0, 'attempts': 0})
+      entry['seconds'] += seconds
+      entry['attempts'] += 1
+      if nbytes is not None:
+          entry['bytes'] = entry.get('bytes', 0) + nbytes
+
+def reporttimings(params, result):
+  if params["timings"]:
+      timings = {}
+      with TIMINGS_LOCK:
+          for phase, entry in request().timings.items():
+              timings[phase] = dict(entry, seconds=round(entry['seconds'], 3))
+              if 'bytes' in entry:
+                  timings[phase]['bytes_per_second'] = int(entry['bytes'] / entry['seconds']) if entry['seconds'] > 0 else None
+      timings['total'] = {'seconds': round(time() - request().timingsstart, 3)}
+      result['timings'] = timings
+
+def getsession():
+  # One keep-alive session per run, shared by every action and the attachment
+  # upload, so consecutive calls to the same apibase reuse the open TLS connection.
+  global SESSION
+  if SESSION is None:
+      SESSION = requests.Session()
+      adapter = HTTPAdapter(pool_connections=CONST_POOLSIZE, pool_maxsize=CONST_POOLSIZE, max_retries=0)
+      SESSION.mount('https://', adapter)
+      SESSION.mount('http://', adapter)
+  return SESSION
+
+def tokenexpiry(tokendata):
+  # AR-JWT tokens are plain JWTs: the expiry is the "exp" claim of the payload.
+  try:
+      payload = tokendata.split('.')[1]
+      payload += '=' * (-len(payload) % 4)
+      return json.loads(base64.urlsafe_b64decode(payload.encode()).decode()).get('exp')
+  except Exception:
+      return None
+
+def readtoken():
+  # The token file is only read again when another process has rewritten it.
+  tokenfile = request().tokenfile
+  mtime = os.stat(tokenfile).st_mtime_ns
+  cached = TOKEN_CACHE.get(tokenfile)
+  if cached is None or cached['mtime'] != mtime:
+      with timed('token_read'):
+          with open(tokenfile, 'r') as file:
+              tokendata = file.read().replace('\n', '')
+              file.close()
+      cached = {'token': tokendata, 'exp': tokenexpiry(tokendata), 'mtime': mtime}
+      TOKEN_CACHE[tokenfile] = cached
+  return cached
+
+def gettoken(tokendir, apibase):
+  cached = readtoken()
+  TOKEN_USED.token = cached['token']
+  if cached['exp'] is not None and cached['exp'] - time() < request().tokenmargin:
+      log("Token expires in less than "+str(request().tokenmargin)+"s. Refreshing ahead of expiry...")
+      refreshtoken(tokendir, apibase, request().user, request().password)
+      cached = readtoken()
+      TOKEN_USED.token = cached['token']
+  return cached['token']
+
 def logout(tokendir, apibase):
   try:
-      tokenfile = CONST_TOKENFILE
       endpoint = apibase + CONST_LOGOUT
       log("Invalidating old token...")
-      with open(tokenfile, 'r') as file:
-          tokendata = file.read().replace('\n', '')
-          file.close()
-          hdrs = {'Authorization': 'AR-JWT ' + tokendata}
-          response = requests.post(endpoint, headers=hdrs)
-          log("Old token invalidated (status code: "+str(response.status_code)+")")
-          return response
+      tokendata = readtoken()['token']
+      hdrs = {'Authorization': 'AR-JWT ' + tokendata}
+      response = getsession().post(endpoint, headers=hdrs, timeout=request().timeout)
+      log("Old token invalidated (status code: "+str(response.status_code)+")")
+      return response
   except Exception as e:
       log("ERROR: "+str(e))
-      response.status_code = 400
-      return response
+      raise
 
 def login(tokendir, apibase, user, password):
-    global CONST_MESSAGE
     log("Logging in (user: '"+user+"', url: '"+apibase+"'")
     try:
-        tokenfile = CONST_TOKENFILE
+        tokenfile = request().tokenfile
         #q = {'username': user, 'password': password}
         q = [('username', user), ('password', password)]
         data = {}
         endpoint = apibase + CONST_LOGIN #+ "?username=" + user + "&password=" + password
         hdrs = {'Content-Type': 'application/x-www-form-urlencoded'}
         #response = requests.post(endpoint, data=data, params=q, headers=hdrs)
-        response = requests.request("POST", endpoint, params=q, headers=hdrs, data=data)
+        response = getsession().request("POST", endpoint, params=q, headers=hdrs, data=data, timeout=request().timeout)
         #response = requests.post(endpoint, data=data, headers=hdrs)
         if response.status_code == 200:
             log("Logged in successfully")
             tokendata = response.text
-            with open(tokenfile, 'w+') as file:
+            # Written aside and renamed over the token file, so other forks
+            # never read it half-written.
+            tmpfile = tokenfile + "." + str(os.getpid()) + "." + str(threading.get_ident()) + ".tmp"
+            with open(tmpfile, 'w') as file:
                 log("Writing token file...")
                 file.write(tokendata)
                 file.close()
+            os.replace(tmpfile, tokenfile)
+            TOKEN_CACHE[tokenfile] = {'token': tokendata.replace('\n', ''), 'exp': tokenexpiry(tokendata), 'mtime': os.stat(tokenfile).st_mtime_ns}
             return response
         else:
             log("Could not login (status_code: "+str(response.status_code)+")")
             return response
     except Exception as e:
         log("Login error: "+str(e))
-        CONST_MESSAGE += str(e)
-        response.status_code = 400
-        return response
+        request().message += str(e)
+        raise
 
 
 def refreshtoken(tokendir, apibase, user, password):
-    global CONST_MESSAGE
+    # Single-flight refresh: one process (and one thread in it) holds the lock
+    # and logs in, the others block on the lock and then pick up the token it
+    # wrote instead of logging in again.
     log("Found invalid token. Refreshing...")
     lockfile = tokendir+"/token_refresh_"+user+".lock"
-    if path.exists(lockfile):
-      log("Token file locked. Waiting for lock to release...")
-      sleep(3)
-      return
-    try:
-        log("Token file locked. Trying to refresh...")
-        open(lockfile, 'a+').close()
-        lock = filelock.FileLock(lockfile, timeout=3)
+    staletoken = getattr(TOKEN_USED, 'token', None)
+    with REFRESH_LOCK, timed('token_refresh'):
         try:
-          logout(tokendir, apibase)
-        except Exception:
-          pass
-        response = login(tokendir, apibase, user, password)
-        if response.status_code == 200:
-            return True
-        else:
-            log("Token refresh error: Authentication failed.")
-            CONST_MESSAGE += "Authentication Failed"
+            with filelock.FileLock(lockfile, timeout=request().locktimeout):
+                log("Token refresh lock acquired")
+                current = readtoken()
+                if current['token'] and current['token'] != staletoken and \
+                        (current['exp'] is None or current['exp'] - time() >= request().tokenmargin):
+                    log("Token already refreshed by another process")
+                    TOKEN_USED.token = current['token']
+                    return True
+                try:
+                  logout(tokendir, apibase)
+                except Exception:
+                  pass
+                response = login(tokendir, apibase, user, password)
+                if response.status_code == 200:
+                    TOKEN_USED.token = readtoken()['token']
+                    return True
+                else:
+                    log("Token refresh error: Authentication failed.")
+                    request().message += "Authentication Failed"
+                    return False
+        except filelock.Timeout:
+            log("Token refresh error: timed out waiting for "+lockfile)
+            request().message += "Timed out waiting for token refresh lock"
+            return False
+        except Exception as e:
+            log("Token refresh error: "+str(e))
+            request().message += str(e)
             return False
-    except Exception as e:
-        log("Token refresh error: "+str(e))
-        CONST_MESSAGE += str(e)
-        sleep(3)
-        return False
-    finally:
-        log("Releasing token file lock...")
-        lock.release(force=True)
-        os.remove(lockfile)
 
 
 def create(tokendir, apibase, data):
-    global CONST_MESSAGE
-    global CONST_TOKENFILE
     log("Creating WO...")
     try:
-        tokenfile = CONST_TOKENFILE
         endpoint = apibase + CONST_API + CONST_CREATEWO
         q = {'fields': 'values(WorkOrder_ID)'}
         data=json.dumps(data)
-        with open(tokenfile, 'r') as file:
-            tokendata = file.read().replace('\n', '')
-            hdrs = {'Authorization': 'AR-JWT ' + tokendata, 'Content-Type': 'application/json'}
-            response = requests.post(endpoint, data=str(data), headers=hdrs, params=q, timeout=300)
-            if response.status_code <= 204:
-                log("WO Created (wiod: "+json.loads(response.text)["values"]["WorkOrder_ID"]+")")
-                return response
-            else:
-                log("Could not create WO (status_code: "+str(response.status_code)+")")
-                return response
+        tokendata = gettoken(tokendir, apibase)
+        hdrs = {'Authorization': 'AR-JWT ' + tokendata, 'Content-Type': 'application/json'}
+        with timed('request'):
+            response = getsession().post(endpoint, data=str(data), headers=hdrs, params=q, timeout=request().timeout)
+        if response.status_code <= 204:
+            log("WO Created (wiod: "+json.loads(response.text)["values"]["WorkOrder_ID"]+")")
+            return response
+        else:
+            log("Could not create WO (status_code: "+str(response.status_code)+")")
+            return response
     except Exception as e:
         log("WO Create ERROR: "+str(e))
-        CONST_MESSAGE += str(e)
-        response.status_code = 400
+        request().message += str(e)
+        raise
+
+
+def getentryid(tokendir, apibase, woids, fields=None):
+    # One query for all of woids, OR-ing a 'Work Order ID' term per WO.
+    try:
+        endpoint = apibase + CONST_API + CONST_MODIFY
+        fields = ['Work Order ID', 'Request ID'] + [f for f in (fields or []) if f not in ('Work Order ID', 'Request ID')]
+        qualification = " OR ".join(["'Work Order ID'"+"="+'"'+woid+'"' for woid in woids])
+        q = {'q': qualification, 'fields': 'values(' + ','.join(fields) + ')', 'limit': len(woids)}
+        tokendata = gettoken(tokendir, apibase)
+        hdrs = {'Authorization': 'AR-JWT ' + tokendata, 'Content-Type': 'application/json'}
+        response = getsession().get(endpoint, params=q, headers=hdrs, timeout=request().timeout)
         return response
+    except Exception as e:
+        log("Entry ID lookup error: "+str(e))
+        request().message += str(e)
+        raise
 
 
-def getentryid(tokendir, apibase, woid):
-    global CONST_MESSAGE
+def searchpage(tokendir, apibase, qualification, fields, offset, limit):
     try:
-        tokenfile = CONST_TOKENFILE
         endpoint = apibase + CONST_API + CONST_MODIFY
-        q = {'q': "'Work Order ID'"+"="+'"'+woid+'"'}
-        with open(tokenfile, 'r') as file:
-            tokendata = file.read().replace('\n', '')
-            hdrs = {'Authorization': 'AR-JWT ' + tokendata, 'Content-Type': 'application/json'}
-            response = requests.get(endpoint, params=q, headers=hdrs, timeout=180)
-            if response.status_code == 200:
-                return response
-            else:
-                response.status_code = 400
-                return response
+        q = {'q': qualification, 'offset': offset, 'limit': limit, 'sort': 'Request ID.asc'}
+        if fields:
+            q['fields'] = 'values(' + ','.join(fields) + ')'
+        tokendata = gettoken(tokendir, apibase)
+        hdrs = {'Authorization': 'AR-JWT ' + tokendata, 'Content-Type': 'application/json'}
+        with timed('request'):
+            response = getsession().get(endpoint, params=q, headers=hdrs, timeout=request().timeout)
+        return response
+    except Exception as e:
+        log("WO search error: "+str(e))
+        request().message += str(e)
+        raise
+
+
+def search(params, result):
+    # Pages through WOI:WorkOrder and streams every entry to params["output"]
+    # as one JSON line, so only the current page is held in memory. Returns
+    # None on success or the failure message.
+    if params["page_size"] < 1:
+        return 'ERROR: page_size must be at least 1'
+    log("Searching WOs (qualification: "+params["qualification"]+")")
+    start = time()
+    count = 0
+    pages = 0
+    output = params["output"]
+    try:
+        with open(output + ".tmp", 'w') as file:
+            while True:
+                offset = count
+                response, message, attempts = retryable(params,
+                                                        lambda: searchpage(params["token_dir"], params["apibase"], params["qualification"], params["fields"], offset, params["page_size"]),
+                                                        lambda r: r.status_code == 200)
+                if response is None:
+                    result['message'] = message + request().message
+                    result['search'] = {'count': count, 'pages': pages, 'seconds': round(time() - start, 3)}
+                    return 'ERROR: Could not search Work Orders'
+                entries = json.loads(response.text).get("entries", [])
+                pages += 1
+                for entry in entries:
+                    file.write(json.dumps(entry.get("values", {})) + "\n")
+                count += len(entries)
+                if len(entries) < params["page_size"]:
+                    break
+        os.replace(output + ".tmp", output)
+    finally:
+        # Left only by a failed search; output itself is never half-written.
+        if os.path.exists(output + ".tmp"):
+            os.remove(output + ".tmp")
+    elapsed = time() - start
+    log("WO search finished ("+str(count)+" entries in "+str(pages)+" pages, "+str(round(elapsed, 3))+"s)")
+    result['search'] = {'count': count, 'pages': pages, 'seconds': round(elapsed, 3), 'output': output}
+    result['message'] = "Found "+str(count)+" Work Orders"
+    return None
+
+
+def entryidcache(tokendir):
+    cachefile = tokendir + "/entryid_cache.json"
+    return cachefile, filelock.FileLock(cachefile + ".lock", timeout=10)
+
+
+def readentryidcache(cachefile):
+    try:
+        with open(cachefile, 'r') as file:
+            return json.load(file)
+    except (IOError, ValueError):
+        return {}
+
+
+def cachedentryids(tokendir, apibase, woids):
+    # Work Order ID -> Request ID never changes, so the mapping is kept in
+    # process and in an on-disk LRU shared by every fork using this token_dir.
+    # Returns {woid: entryid} for the woids found in either.
+    found = {}
+    for woid in woids:
+        if apibase + "|" + woid in ENTRYID_CACHE:
+            found[woid] = ENTRYID_CACHE[apibase + "|" + woid]
+    if len(found) == len(woids) or request().entryidcachesize <= 0:
+        return found
+    try:
+        cachefile, lock = entryidcache(tokendir)
+        with lock:
+            cache = readentryidcache(cachefile)
+            hits = [woid for woid in woids if woid not in found and apibase + "|" + woid in cache]
+            if not hits:
+                return found
+            for woid in hits:
+                key = apibase + "|" + woid
+                cache[key][1] = time()
+                ENTRYID_CACHE[key] = found[woid] = cache[key][0]
+            with open(cachefile + ".tmp", 'w') as file:
+                json.dump(cache, file)
+            os.replace(cachefile + ".tmp", cachefile)
+        return found
+    except Exception as e:
+        log("Entry ID cache read error: "+str(e))
+        return found
+
+
+def cachedentryid(tokendir, apibase, woid):
+    return cachedentryids(tokendir, apibase, [woid]).get(woid)
+
+
+def storeentryids(tokendir, apibase, entryids):
+    for woid, entryid in entryids.items():
+        ENTRYID_CACHE[apibase + "|" + woid] = entryid
+    if request().entryidcachesize <= 0 or not entryids:
+        return
+    try:
+        cachefile, lock = entryidcache(tokendir)
+        with lock:
+            cache = readentryidcache(cachefile)
+            for woid, entryid in entryids.items():
+                cache[apibase + "|" + woid] = [entryid, time()]
+            if len(cache) > request().entryidcachesize:
+                oldest = sorted(cache, key=lambda k: cache[k][1])
+                for k in oldest[:len(cache) - request().entryidcachesize]:
+                    del cache[k]
+            with open(cachefile + ".tmp", 'w') as file:
+                json.dump(cache, file)
+            os.replace(cachefile + ".tmp", cachefile)
     except Exception as e:
+        log("Entry ID cache write error: "+str(e))
+
+
+def storeentryid(tokendir, apibase, woid, entryid):
+    storeentryids(tokendir, apibase, {woid: entryid})
+
+
+def resolveentryids(tokendir, apibase, woids, fields=None):
+    # Resolves the woids missing from the cache with one query per
+    # resolve_chunk_size of them. Returns ({woid: entryid}, response) where
+    # response is that of the last query run (None when all were cached); a
+    # failed query stops the resolution and is the one returned. The queries
+    # also fetch fields, left in the request's entryvalues for modify; when
+    # fields are asked for, cached woids are queried too so their values come
+    # in the same chunks.
+    woids = list(dict.fromkeys(woids))
+    found = cachedentryids(tokendir, apibase, woids)
+    missing = [woid for woid in woids if fields or woid not in found]
+    response = None
+    for start in range(0, len(missing), request().resolvechunk):
+        chunk = missing[start:start + request().resolvechunk]
+        with timed('entryid_lookup'):
+            response = getentryid(tokendir, apibase, chunk, fields)
+        if response.status_code != 200:
+            return found, response
+        resolved = {}
+        for entry in json.loads(response.text)["entries"]:
+            woid = entry["values"]["Work Order ID"]
+            resolved[woid] = entry["values"]["Request ID"]
+            if fields:
+                request().entryvalues[apibase + "|" + woid] = (fields, entry["values"], response)
+        storeentryids(tokendir, apibase, resolved)
+        found.update(resolved)
+    if len(missing) > 1:
+        log("Resolved "+str(len(found))+" of "+str(len(woids))+" Work Order IDs ("+str(len(missing))+" queried)")
+    return found, response
+
+
+def resolveentryid(tokendir, apibase, woid, fields=None):
+    # Returns (entryid, None) or (None, failed getentryid response).
+    found, response = resolveentryids(tokendir, apibase, [woid], fields)
+    if woid in found:
+        return found[woid], None
+    if response.status_code == 200:
+        log("Work Order not found (woid: "+woid+")")
+        request().message += "Work Order not found: "+woid
         response.status_code = 400
-        return response
+    return None, response
+
+
+def prefetchentryids(params, woids, fields=None):
+    # Resolves the entry IDs of a list of WOs in a few chunked queries ahead of
+    # the per-WO work, which then finds them all in the cache.
+    woids = [woid for woid in woids if woid]
+    if not woids:
+        return
+    retryable(params,
+              lambda: resolveentryids(params["token_dir"], params["apibase"], woids, fields)[1],
+              lambda r: r is None or r.status_code == 200)
+
+
+def currentvalues(tokendir, apibase, woid, fields):
+    # Current values of fields on the WO, taken from the entry ID lookup (a
+    # prefetch or one run here), otherwise from a GET of those fields on the
+    # entry. Returns
+    # (entryid, values, response); values is None when they could not be read.
+    fetched = request().entryvalues.pop(apibase + "|" + woid, None)
+    if fetched is None or not set(fields) <= set(fetched[0]):
+        entryid, response = resolveentryid(tokendir, apibase, woid, fields)
+        if entryid is None:
+            return None, None, response
+        fetched = request().entryvalues.pop(apibase + "|" + woid, None)
+    else:
+        entryid = cachedentryid(tokendir, apibase, woid)
+    if fetched is not None and set(fields) <= set(fetched[0]):
+        return entryid, fetched[1], fetched[2]
+    endpoint = apibase + CONST_API + CONST_MODIFY + "/" + entryid
+    q = {'fields': 'values(' + ','.join(fields) + ')'}
+    tokendata = gettoken(tokendir, apibase)
+    hdrs = {'Authorization': 'AR-JWT ' + tokendata, 'Content-Type': 'application/json'}
+    with timed('entry_read'):
+        response = getsession().get(endpoint, params=q, headers=hdrs, timeout=request().timeout)
+    if response.status_code != 200:
+        return entryid, None, response
+    return entryid, json.loads(response.text).get("values", {}), response
+
+
+def samevalue(current, wanted):
+    # Remedy returns most values as strings; None and "" both mean unset.
+    if current in (None, '') or wanted in (None, ''):
+        return current in (None, '') and wanted in (None, '')
+    return current == wanted or str(current) == str(wanted)
 
 
 def modify(tokendir, apibase, woid, data):
-    global CONST_MESSAGE
-    log("Modifying WO (woid: "+woid+") with status '"+data["values"]["Status"]+"'")
+    log("Modifying WO (woid: "+woid+") with status '"+str(data["values"].get("Status"))+"'")
     try:
-        tokenfile = CONST_TOKENFILE
-        entryidresponse = getentryid(tokendir, apibase, woid)
-        if entryidresponse.status_code == 400:
-            return entryidresponse
-        entryid = json.loads(entryidresponse.text)["entries"][0]["values"]["Request ID"]
-        endpoint = apibase + CONST_API + CONST_MODIFY + "/" + entryid
-        with open(tokenfile, 'r') as file:
-            tokendata = file.read().replace('\n', '')
-            hdrs = {'Authorization': 'AR-JWT ' + tokendata, 'Content-Type': 'application/json'}
-            response = requests.put(endpoint, json=data, headers=hdrs)
-            if response.status_code == 204:
-                log("WO modified successfully (woid: "+woid+")")
+        if request().onlychanged:
+            # Send only the fields whose value differs. When none does, skip the
+            # PUT and hand back the read response marked unchanged.
+            entryid, current, response = currentvalues(tokendir, apibase, woid, list(data["values"].keys()))
+            if entryid is None or current is None:
                 return response
-            else:
-                log("Could not modify WO (woid: "+woid+")")
+            changes = dict((k, v) for k, v in data["values"].items() if not samevalue(current.get(k), v))
+            if not changes:
+                log("WO already up to date, nothing to modify (woid: "+woid+")")
+                response.unchanged = True
                 return response
+            data = dict(data, values=changes)
+        else:
+            entryid, entryidresponse = resolveentryid(tokendir, apibase, woid)
+            if entryid is None:
+                return entryidresponse
+        endpoint = apibase + CONST_API + CONST_MODIFY + "/" + entryid
+        tokendata = gettoken(tokendir, apibase)
+        hdrs = {'Authorization': 'AR-JWT ' + tokendata, 'Content-Type': 'application/json'}
+        with timed('request'):
+            response = getsession().put(endpoint, json=data, headers=hdrs, timeout=request().timeout)
+        if response.status_code == 204:
+            log("WO modified successfully (woid: "+woid+")")
+            return response
+        else:
+            log("Could not modify WO (woid: "+woid+")")
+            return response
     except Exception as e:
         log("WO modify error: "+str(e))
-        CONST_MESSAGE += str(e)
-        response.status_code = 400
-        return response
+        request().message += str(e)
+        raise
+
+
+class MultipartStream(object):
+    # File-like multipart body for requests. Only the part headers are held in
+    # memory; the attachment is read from disk in CONST_CHUNKSIZE chunks while
+    # it is sent, and __len__ gives requests the Content-Length up front.
+    def __init__(self, head, filename, tail):
+        self.size = len(head) + os.path.getsize(filename) + len(tail)
+        self.sent = 0
+        self.chunks = self.generate(head, filename, tail)
+        self.current = b''
+        self.offset = 0
+
+    def generate(self, head, filename, tail):
+        yield head
+        with open(filename, 'rb') as f:
+            while True:
+                chunk = f.read(CONST_CHUNKSIZE)
+                if not chunk:
+                    break
+                yield chunk
+        yield tail
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size
+        pieces = []
+        while size > 0:
+            if self.offset >= len(self.current):
+                self.current = next(self.chunks, b'')
+                self.offset = 0
+                if not self.current:
+                    break
+            piece = self.current[self.offset:self.offset + size]
+            self.offset += len(piece)
+            size -= len(piece)
+            pieces.append(piece)
+        data = b''.join(pieces)
+        self.sent += len(data)
+        return data
 
 
 def addattachment(tokendir, apibase, woid, data, filename):
-    global CONST_MESSAGE
     log("Adding attachment (woid: "+woid+")")
     try:
         head, tail = os.path.split(filename)
-        entryidresponse = getentryid(tokendir, apibase, woid)
-        if entryidresponse.status_code == 400:
+        entryid, entryidresponse = resolveentryid(tokendir, apibase, woid)
+        if entryid is None:
             return entryidresponse
-        entryid = json.loads(entryidresponse.text)["entries"][0]["values"]["Request ID"]
-        apibase = apibase.replace('https://', '')
-        conn = http.client.HTTPSConnection(apibase, 443, context=ssl._create_unverified_context())
-        tokenfile = CONST_TOKENFILE
+        endpoint = apibase + CONST_API + CONST_ATTACHMENT
         data["values"]["Work Order ID"] = woid
         data["values"]["WorkOrder_EntryID"] = woid
         data["values"]["z2AF Work Log01"] = tail
-        with open(tokenfile, 'r') as file:
-            tokendata = file.read().replace('\n', '')
-            dataList = []
-            boundary = b'wL36Yn8afVp8Ag7AmP8qZ0SA4n1v9T'
-            dataList.append(b'--' + boundary)
-            dataList.append(b'Content-Disposition: form-data; name="entry";')
-            dataList.append(b'Content-Type: application/json')
-            dataList.append(b'')
-            dataList.append(json.dumps(data).encode())
-            dataList.append(b'--' + boundary)
-            dataList.append(b'Content-Disposition: form-data; name="attach-z2AF Work Log01"; filename='+tail.encode())
-            fileType = b'application/octet-stream'
-            dataList.append(b'Content-Type: '+fileType)
-            dataList.append(b'')
-            with open(filename, 'rb') as f:
-                filecontent = f.read()
-                encoding = chardet.detect(filecontent)
-                dataList.append(filecontent)
-                f.close()
-            dataList.append(b'--' + boundary + b'--')
-            dataList.append(b'')
-            body = b'\r\n'.join(dataList)
-            payload = body
-            headers = {
-                b'Authorization': b'AR-JWT ' + tokendata.encode(),
-                b'Accept-Encoding': b'gzip, deflate, br',
-                b'Content-type': b'multipart/form-data; boundary=' + boundary
-            }
-            conn.request("POST",  CONST_API + CONST_ATTACHMENT, payload, headers)
-            res = conn.getresponse()
-            log("File attached successfully (woid: "+woid+")")
-            return res
+        tokendata = gettoken(tokendir, apibase)
+        dataList = []
+        boundary = b'wL36Yn8afVp8Ag7AmP8qZ0SA4n1v9T'
+        dataList.append(b'--' + boundary)
+        dataList.append(b'Content-Disposition: form-data; name="entry";')
+        dataList.append(b'Content-Type: application/json')
+        dataList.append(b'')
+        dataList.append(json.dumps(data).encode())
+        dataList.append(b'--' + boundary)
+        dataList.append(b'Content-Disposition: form-data; name="attach-z2AF Work Log01"; filename='+tail.encode())
+        fileType = (mimetypes.guess_type(tail)[0] or 'application/octet-stream').encode()
+        dataList.append(b'Content-Type: '+fileType)
+        dataList.append(b'')
+        dataList.append(b'')
+        payload = MultipartStream(b'\r\n'.join(dataList), filename, b'\r\n--' + boundary + b'--\r\n')
+        headers = {
+            'Authorization': 'AR-JWT ' + tokendata,
+            'Content-type': 'multipart/form-data; boundary=' + boundary.decode()
+        }
+        start = time()
+        response = getsession().post(endpoint, data=payload, headers=headers, timeout=request().timeout)
+        elapsed = time() - start
+        addtiming('upload', elapsed, payload.sent)
+        if response.status_code != 201:
+            log("Could not attach file (woid: "+woid+", status_code: "+str(response.status_code)+")")
+            return response
+        response.upload = {
+            'bytes': payload.sent,
+            'seconds': round(elapsed, 3),
+            'bytes_per_second': int(payload.sent / elapsed) if elapsed > 0 else None
+        }
+        log("File attached successfully (woid: "+woid+", "+str(payload.sent)+" bytes in "+str(round(elapsed, 3))+"s)")
+        return response
     except Exception as e:
         log("File attachment error: "+str(e))
-        CONST_MESSAGE += str(e)
-        return 400
+        request().message += str(e)
+        raise
 
 
-def run_module():
-    global CONST_TOKENFILE
-    global CONST_MESSAGE
+def setup(params):
     global LOG_HANDLER
-    global LOG
-    global LOG_ID
+    global LOG_FILE
+    global LOG_MODE
+    global LOG_LISTENER
+    global LOG_BUFFER
+    global CONST_POOLSIZE
+    state = REQUEST.state = RequestState()
+    CONST_POOLSIZE = max(params["pool_size"], params["concurrency"])
+    state.timeout = (params["connect_timeout"], params["read_timeout"])
+    fname = params["token_dir"] + "/token_"+params['user']+".txt"
+    state.tokenfile = fname
+    state.tokenmargin = params["token_refresh_margin"]
+    state.locktimeout = params["token_lock_timeout"]
+    state.numretries = max(1, params["retries"])
+    state.retrydelay = params["retry_delay"]
+    state.retrymaxdelay = params["retry_max_delay"]
+    state.circuitthreshold = params["circuit_threshold"]
+    state.circuitcooldown = params["circuit_cooldown"]
+    state.user = params["user"]
+    state.password = params["password"]
+    state.entryidcachesize = params["entryid_cache_size"]
+    state.resolvechunk = max(1, params["resolve_chunk_size"])
+    state.onlychanged = params["only_changed"]
+    if not os.path.exists(fname):
+        with open(fname, 'a') as f:
+            f.write("")
+            f.close()
+        # No login against an endpoint the circuit breaker holds open;
+        # runaction fails fast (or queues) on the same check.
+        if not queued(params) and circuitallow(params)[0]:
+            refreshtoken(params["token_dir"], params["apibase"], params["user"], params["password"])
+    state.logcontext = {'action': params['action'], 'woid': params.get('woid'), 'start': time()}
+    if params["log"]:
+        if params["logfile"] == "None":
+          state.message += "Logging file not specified. Logging NOT enabled"
+          state.log = False
+        else:
+            try:
+                # Use an absolute path to prevent file rotation trouble.
+                logfile = os.path.abspath(params["logfile"])
+                with LOG_LOCK:
+                    if logfile != LOG_FILE or params["log_mode"] != LOG_MODE:
+                        stoplog()
+                        LOG_HANDLER = getLogger(__name__)
+                        # Rotate log after reaching 100M, keep 5 old copies.
+                        rotateHandler = ConcurrentRotatingFileHandler(logfile, "a", 100*1024*1024, 3)
+                        LOG_HANDLER.handlers = []
+                        if params["log_mode"] == "queue":
+                            # Records go onto an in-process queue; a listener thread
+                            # buffers them and the file is written once at exit.
+                            logqueue = queue.Queue(-1)
+                            LOG_BUFFER = BufferedLogHandler(rotateHandler)
+                            LOG_LISTENER = QueueListener(logqueue, LOG_BUFFER)
+                            LOG_LISTENER.start()
+                            atexit.register(stoplog)
+                            LOG_HANDLER.addHandler(QueueHandler(logqueue))
+                        else:
+                            LOG_HANDLER.addHandler(rotateHandler)
+                        LOG_HANDLER.setLevel(INFO)
+                        LOG_FILE = logfile
+                        LOG_MODE = params["log_mode"]
+                state.log = True
+                state.logid = params["log_identifier"]
+            except Exception as e:
+                state.message += "Could not create logfile. Logging NOT enabled: "+str(e)
+                state.log = False
+
+
+def classify(response, error=None):
+    # Sorts a failed attempt into 'auth' (refresh the token and retry),
+    # 'retry' (throttling, server errors, timeouts: back off and retry) or
+    # 'fatal' (client errors that will fail again: stop).
+    if error is not None:
+        if isinstance(error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)):
+            return 'retry'
+        return 'fatal'
+    if response.status_code == 401:
+        return 'auth'
+    if response.status_code == 429 or response.status_code >= 500:
+        return 'retry'
+    return 'fatal'
+
+
+def retryafter(response):
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+
+def backoffdelay(attempt, response):
+    # Retry-After wins when the server sends it; otherwise exponential backoff
+    # with jitter. Both are capped at retry_max_delay.
+    delay = retryafter(response)
+    if delay is None:
+        delay = min(request().retrymaxdelay, request().retrydelay * (2 ** attempt))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+    return min(delay, request().retrymaxdelay)
+
+
+def circuitfile(params):
+    name = hashlib.sha1(params["apibase"].encode()).hexdigest()[:16]
+    return params["token_dir"] + "/circuit_" + name + ".json"
+
+
+def readcircuit(statefile):
+    try:
+        with open(statefile, 'r') as file:
+            return json.load(file)
+    except (IOError, ValueError):
+        return {'state': 'closed', 'failures': 0, 'opened': 0, 'probe': 0}
+
+
+def writecircuit(statefile, state):
+    with open(statefile + ".tmp", 'w') as file:
+        json.dump(state, file)
+    os.replace(statefile + ".tmp", statefile)
+
+
+def circuitallow(params):
+    # Circuit breaker shared by every fork through a small state file per
+    # apibase. Closed: requests go out. Open: they fail at once until
+    # circuit_cooldown has passed, then a single process gets to send a
+    # half-open probe while the others keep failing fast. Returns
+    # (allowed, seconds until the next probe).
+    if request().circuitthreshold <= 0 or request().circuitprobe:
+        return True, 0
+    statefile = circuitfile(params)
+    try:
+        with CIRCUIT_LOCK, filelock.FileLock(statefile + ".lock", timeout=request().locktimeout):
+            state = readcircuit(statefile)
+            if state['state'] == 'closed':
+                request().circuitdirty = state['failures'] > 0
+                return True, 0
+            request().circuitdirty = True
+            since = time() - (state['opened'] if state['state'] == 'open' else state['probe'])
+            if since < request().circuitcooldown:
+                return False, request().circuitcooldown - since
+            log("Circuit half-open for "+params["apibase"]+". Sending probe...")
+            state['state'] = 'half_open'
+            state['probe'] = time()
+            writecircuit(statefile, state)
+            request().circuitprobe = True
+            return True, 0
+    except Exception as e:
+        # An unreadable or locked state file must not stop the task: fail open.
+        log("Circuit state error: "+str(e))
+        return True, 0
+
+
+def circuitrecord(params, ok):
+    # Successes only touch the state file when something is there to reset.
+    # Returns False once the circuit is open, so retry loops stop early.
+    if request().circuitthreshold <= 0 or (ok and not request().circuitdirty):
+        return True
+    statefile = circuitfile(params)
+    try:
+        with CIRCUIT_LOCK, filelock.FileLock(statefile + ".lock", timeout=request().locktimeout):
+            state = readcircuit(statefile)
+            if ok:
+                if state['state'] != 'closed':
+                    log("Circuit closed for "+params["apibase"])
+                state = {'state': 'closed', 'failures': 0, 'opened': 0, 'probe': 0}
+                request().circuitdirty = False
+            else:
+                state['failures'] += 1
+                if state['state'] == 'half_open' or state['failures'] >= request().circuitthreshold:
+                    if state['state'] != 'open':
+                        log("Circuit opened for "+params["apibase"]+" after "+str(state['failures'])+" consecutive failures")
+                    state['state'] = 'open'
+                    state['opened'] = time()
+                request().circuitdirty = True
+            request().circuitprobe = False
+            writecircuit(statefile, state)
+            return state['state'] != 'open'
+    except Exception as e:
+        log("Circuit state error: "+str(e))
+        return True
+
+
+def retryable(params, call, succeeded):
+    # Runs call() until succeeded(response) or the retry policy gives up.
+    # Returns (response, None, attempts) on success or (None, message, attempts).
+    message = ''
+    attempts = 0
+    for attempt in range(request().numretries):
+        attempts += 1
+        response = None
+        try:
+            response = call()
+            if succeeded(response):
+                circuitrecord(params, True)
+                return response, None, attempts
+            kind = classify(response)
+            message = response.text
+        except Exception as e:
+            kind = classify(None, e)
+            message = str(e)
+        if kind == 'retry':
+            if not circuitrecord(params, False):
+                break
+        elif response is not None:
+            circuitrecord(params, True)
+        if kind == 'fatal' or attempt == request().numretries - 1:
+            break
+        if kind == 'auth':
+            refreshtoken(params['token_dir'], params['apibase'], params['user'], params['password'])
+        else:
+            delay = backoffdelay(attempt, response)
+            log("Retrying in "+str(round(delay, 2))+"s (attempt "+str(attempts)+" failed: "+message[:200]+")")
+            with timed('retry_sleep'):
+                sleep(delay)
+    if kind == 'retry':
+        # Gave up on a throttled, failing or unreachable server: worth trying
+        # again later, so the outbox does not count it against an operation.
+        request().transient = True
+    return None, message, attempts
+
+
+def createone(params, data):
+    # Create one Work Order. Returns (woid, None, attempts) on success or
+    # (None, last error message, attempts).
+    response, message, attempts = retryable(params,
+                                            lambda: create(params["token_dir"], params["apibase"], data),
+                                            lambda r: r.status_code <= 204)
+    if response is None:
+        return None, message, attempts
+    return json.loads(response.text)["values"]["WorkOrder_ID"], None, attempts
+
+
+def modifyone(params, woid, data):
+    if not woid or not data:
+        return {'woid': woid, 'changed': False, 'error': 'Each item needs a woid and data', 'attempts': 0}
+    response, message, attempts = retryable(params,
+                                            lambda: modify(params["token_dir"], params["apibase"], woid, data),
+                                            lambda r: r.status_code == 204 or getattr(r, 'unchanged', False))
+    changed = response is not None and not getattr(response, 'unchanged', False)
+    return {'woid': woid, 'changed': changed, 'error': message, 'attempts': attempts}
+
+
+async def modifybulk(params):
+    # The event loop keeps up to params["concurrency"] items in flight, each
+    # doing its entry ID lookup and PUT on a worker thread over the shared
+    # session, so wall-clock time follows the in-flight limit instead of the
+    # sum of round-trips.
+    loop = asyncio.get_running_loop()
+    limit = asyncio.Semaphore(params["concurrency"])
+    executor = ThreadPoolExecutor(max_workers=params["concurrency"])
+
+    async def modifyitem(item):
+        async with limit:
+            return await loop.run_in_executor(executor, inrequest(modifyone), params, item.get("woid"), item.get("data"))
+
+    try:
+        return await asyncio.gather(*[modifyitem(item) for item in params["items"]])
+    finally:
+        executor.shutdown(wait=True)
+
+
+def queued(params):
+    return params.get("async_outbox") and params["action"] in CONST_OUTBOXACTIONS
+
+
+def outboxpath(params):
+    if params["outbox_db"]:
+        return params["outbox_db"]
+    return params["token_dir"] + "/remedy_outbox.db"
+
+
+def outbox(params):
+    conn = sqlite3.connect(outboxpath(params), timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=FULL")
+    conn.execute("CREATE TABLE IF NOT EXISTS operations ("
+                 "id INTEGER PRIMARY KEY AUTOINCREMENT, action TEXT NOT NULL, payload TEXT NOT NULL, "
+                 "status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, woid TEXT, error TEXT, "
+                 "result TEXT, created REAL NOT NULL, updated REAL NOT NULL)")
+    conn.execute("CREATE INDEX IF NOT EXISTS operations_status ON operations (status, id)")
+    return conn
+
+
+def enqueue(params, result):
+    # Only the operation itself is stored; the drain supplies the credentials.
+    payload = dict((field, params.get(field)) for field in CONST_OUTBOXFIELDS)
+    now = time()
+    conn = outbox(params)
+    try:
+        with conn:
+            cursor = conn.execute("INSERT INTO operations (action, payload, status, created, updated) VALUES (?, ?, 'pending', ?, ?)",
+                                  (params['action'], json.dumps(payload), now, now))
+        operationid = cursor.lastrowid
+    finally:
+        conn.close()
+    log("Queued "+params['action']+" in outbox (operation_id: "+str(operationid)+")")
+    result['operation_id'] = operationid
+    result['changed'] = True
+    result['message'] = "Queued "+params['action']+" as outbox operation "+str(operationid)
+    return None
+
+
+def drainoutbox(params, result, maxbatches=None):
+    # Sends pending operations in id order, batch_size rows at a time. An
+    # operation that fails is retried by later drains and marked failed after
+    # retries failed drains; until then the drain stops there so that later
+    # operations are not sent ahead of it. Only fatal failures count: one the
+    # server was unavailable for (retry-class errors, open circuit) leaves
+    # attempts unchanged and the operation pending.
+    lock = filelock.FileLock(outboxpath(params) + ".drain.lock")
+    try:
+        lock.acquire(timeout=0)
+    except filelock.Timeout:
+        result['message'] = "Outbox drain already running"
+        return None
+    sent = 0
+    failed = 0
+    batches = 0
+    try:
+        conn = outbox(params)
+        try:
+            blocked = False
+            while not blocked and (maxbatches is None or batches < maxbatches):
+                rows = conn.execute("SELECT id, action, payload, attempts FROM operations WHERE status = 'pending' ORDER BY id LIMIT ?",
+                                    (params["batch_size"],)).fetchall()
+                if not rows:
+                    break
+                batches += 1
+                prefetchentryids(params, [json.loads(row[2]).get("woid") for row in rows if row[1] != 'create'])
+                for operationid, action, payload, attempts in rows:
+                    payload = json.loads(payload)
+                    opparams = dict(params)
+                    opparams.update(payload)
+                    opparams["async_outbox"] = False
+                    # An operation the circuit breaker stops is left where it
+                    # is, not queued a second time.
+                    opparams["circuit_queue"] = False
+                    opresult = dict(
+                        changed=False,
+                        original_message='',
+                        message=''
+                    )
+                    request().message = ""
+                    request().transient = False
+                    try:
+                        msg = runaction(opparams, opresult)
+                    except Exception as e:
+                        msg = str(e)
+                    if 'circuit' in opresult:
+                        # Circuit open: the operation was not attempted. It
+                        # stays pending with its attempts unchanged, and the
+                        # drain stops until the endpoint is back.
+                        log("Outbox operation "+str(operationid)+" ("+action+"): circuit open, drain stopped")
+                        result['circuit'] = opresult['circuit']
+                        blocked = True
+                        break
+                    if msg is not None and request().transient:
+                        status = 'pending'
+                    else:
+                        attempts += 1
+                        if msg is None:
+                            status = 'done'
+                            sent += 1
+                        elif attempts >= request().numretries:
+                            status = 'failed'
+                            failed += 1
+                        else:
+                            status = 'pending'
+                    woid = opresult['message'] if action in ('create', 'workflow') and msg is None else payload.get('woid')
+                    with conn:
+                        conn.execute("UPDATE operations SET status = ?, attempts = ?, woid = ?, error = ?, result = ?, updated = ? WHERE id = ?",
+                                     (status, attempts, woid, msg, json.dumps(opresult), time(), operationid))
+                    log("Outbox operation "+str(operationid)+" ("+action+"): "+status)
+                    if status == 'pending':
+                        blocked = True
+                        break
+            pending = conn.execute("SELECT COUNT(*) FROM operations WHERE status = 'pending'").fetchone()[0]
+        finally:
+            conn.close()
+    finally:
+        lock.release()
+    result['drain'] = {'sent': sent, 'failed': failed, 'pending': pending, 'batches': batches}
+    result['changed'] = sent > 0 or failed > 0
+    result['message'] = "Sent "+str(sent)+" outbox operations, "+str(failed)+" failed, "+str(pending)+" pending"
+    return None
+
+
+def outboxstatus(params, result):
+    conn = outbox(params)
+    try:
+        row = conn.execute("SELECT action, status, attempts, woid, error, result, created, updated FROM operations WHERE id = ?",
+                           (params["operation_id"],)).fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return 'ERROR: Unknown outbox operation: '+str(params["operation_id"])
+    action, status, attempts, woid, error, opresult, created, updated = row
+    result['operation'] = {
+        'operation_id': params["operation_id"],
+        'action': action,
+        'status': status,
+        'attempts': attempts,
+        'woid': woid,
+        'error': error,
+        'result': json.loads(opresult) if opresult else None,
+        'created': created,
+        'updated': updated
+    }
+    result['message'] = woid if woid else status
+    return None
+
+
+def expandfilenames(params):
+    # filename plus every entry of filenames, globs expanded. Paths that match
+    # nothing are kept so they are reported as failed files.
+    filenames = [params["filename"]] if params.get("filename") else []
+    for pattern in params["filenames"]:
+        matches = sorted(glob.glob(pattern))
+        filenames.extend(matches if matches else [pattern])
+    return filenames
+
+
+def attachone(params, filename):
+    # Every file gets its own copy of data: addattachment fills in the file
+    # name fields of the entry.
+    start = time()
+    size = os.path.getsize(filename) if os.path.isfile(filename) else None
+    response, message, attempts = retryable(params,
+                                            lambda: addattachment(params["token_dir"], params["apibase"], params["woid"], copy.deepcopy(params["data"]), filename),
+                                            lambda r: r.status_code == 201)
+    return {
+        'filename': filename,
+        'size': size,
+        'changed': response is not None,
+        'error': message,
+        'attempts': attempts,
+        'seconds': round(time() - start, 3),
+        'upload': response.upload if response is not None else None
+    }
+
+
+def runaction(params, result):
+    # Runs the requested action and fills in result. Returns None on success or
+    # the failure message, so the direct path and the gateway share it.
+    global GATEWAY_OUTBOX
+    result['original_message'] = params['action']
+    if queued(params):
+        msg = enqueue(params, result)
+        with GATEWAY_LOCK:
+            GATEWAY_OUTBOX = params
+            GATEWAY_WAKE.set()
+        return msg
+
+    if params['action'] == 'outbox_status':
+        return outboxstatus(params, result)
+
+    allowed, retryin = circuitallow(params)
+    if not allowed:
+        result['circuit'] = {'state': 'open', 'retry_in': round(retryin, 1)}
+        if params["circuit_queue"] and params['action'] in CONST_OUTBOXACTIONS:
+            return enqueue(params, result)
+        result['message'] = "Remedy endpoint "+params["apibase"]+" is unavailable, next attempt in "+str(round(retryin, 1))+"s"
+        return 'ERROR: Circuit breaker open'
+
+    if params['action'] == 'outbox_drain':
+        return drainoutbox(params, result)
+
+    elif params['action'] == 'create':
+        woid, message, result['attempts'] = createone(params, params["data"])
+        if woid is None:
+            result['message'] = message + request().message
+            return 'ERROR: Could not create Work Order'
+        result['message'] = woid
+        result['changed'] = True
+
+    elif params['action'] == 'create_batch':
+        # Every item is created independently: a slow or failed item neither
+        # blocks the others nor aborts the batch.
+        results = [None] * len(params["items"])
+        with ThreadPoolExecutor(max_workers=params["concurrency"]) as executor:
+            futures = {}
+            for index, data in enumerate(params["items"]):
+                futures[executor.submit(inrequest(createone), params, data)] = index
+            for future in as_completed(futures):
+                index = futures[future]
+                woid, message, attempts = future.result()
+                results[index] = {'index': index, 'woid': woid, 'error': message, 'attempts': attempts}
+        created = len([r for r in results if r['woid'] is not None])
+        result['results'] = results
+        result['changed'] = created > 0
+        result['message'] = "Created "+str(created)+" of "+str(len(results))+" Work Orders"
+        if created < len(results):
+            result['message'] += request().message
+            return 'ERROR: Could not create '+str(len(results) - created)+' of '+str(len(results))+' Work Orders'
+
+    elif params['action'] == 'add_attachment' and params.get("filenames"):
+        filenames = expandfilenames(params)
+        if not filenames:
+            return 'ERROR: No files match '+', '.join(params["filenames"])
+        # Resolve the entry ID once up front so the workers all hit the cache.
+        prefetchentryids(params, [params["woid"]])
+        with ThreadPoolExecutor(max_workers=params["concurrency"]) as executor:
+            results = list(executor.map(inrequest(lambda filename: attachone(params, filename)), filenames))
+        attached = len([r for r in results if r['changed']])
+        result['results'] = results
+        result['changed'] = attached > 0
+        result['message'] = "Attached "+str(attached)+" of "+str(len(results))+" files"
+        if attached < len(results):
+            result['message'] += request().message
+            return 'ERROR: Could not attach '+str(len(results) - attached)+' of '+str(len(results))+' files to Work Order'
+
+    elif params['action'] == 'add_attachment':
+        response, message, result['attempts'] = retryable(params,
+                                                          lambda: addattachment(params["token_dir"], params["apibase"], params["woid"], params["data"], params["filename"]),
+                                                          lambda r: r.status_code == 201)
+        if response is None:
+            result['message'] = message + request().message
+            return 'ERROR: Could not attach file to Work Order'
+        result['changed'] = True
+        result['message'] = response.text
+        result['upload'] = response.upload
+
+    elif params['action'] == 'modify':
+        response, message, result['attempts'] = retryable(params,
+                                                          lambda: modify(params["token_dir"], params["apibase"], params["woid"], params["data"]),
+                                                          lambda r: r.status_code == 204 or getattr(r, 'unchanged', False))
+        if response is None:
+            result['message'] = message + request().message
+            return 'ERROR: Could not modify Work Order'
+        if getattr(response, 'unchanged', False):
+            result['message'] = "Work Order already up to date"
+        else:
+            result['changed'] = True
+            result['message'] = response.text
+
+    elif params['action'] == 'modify_bulk':
+        fields = None
+        if request().onlychanged:
+            fields = list(dict.fromkeys([k for item in params["items"] for k in ((item.get("data") or {}).get("values") or {})]))
+        prefetchentryids(params, [item.get("woid") for item in params["items"]], fields)
+        results = asyncio.run(modifybulk(params))
+        modified = len([r for r in results if r['changed']])
+        failed = len([r for r in results if r['error'] is not None])
+        result['results'] = results
+        result['changed'] = modified > 0
+        result['message'] = "Modified "+str(modified)+" of "+str(len(results))+" Work Orders"
+        if failed > 0:
+            result['message'] += request().message
+            return 'ERROR: Could not modify '+str(failed)+' of '+str(len(results))+' Work Orders'
+
+    elif params['action'] == 'search':
+        return search(params, result)
+
+    elif params['action'] == 'workflow':
+        # Ordered steps in one process: one session, one token, one entry ID
+        # lookup. The WorkOrder_ID of a create step becomes the woid of the
+        # steps after it. A step only sets the CONST_STEPFIELDS; every other
+        # option (apibase, credentials, retries...) comes from the task.
+        woid = params["woid"]
+        prefetchentryids(params, [woid] + [step.get("woid") for step in params["steps"]])
+        result['steps'] = []
+        for index, step in enumerate(params["steps"]):
+            if step.get("action") not in CONST_WORKFLOWACTIONS:
+                return 'ERROR: Workflow step '+str(index)+' has an invalid action: '+str(step.get("action"))
+            stepparams = dict(params)
+            stepparams.update((field, step[field]) for field in CONST_STEPFIELDS if field in step)
+            if not step.get("woid"):
+                stepparams["woid"] = woid
+            stepparams["data"] = step.get("data") or {"values": {}}
+            stepresult = dict(
+                changed=False,
+                original_message='',
+                message=''
+            )
+            msg = runaction(stepparams, stepresult)
+            stepresult['action'] = step["action"]
+            stepresult['woid'] = stepparams["woid"]
+            result['steps'].append(stepresult)
+            result['changed'] = result['changed'] or stepresult['changed']
+            if msg is not None:
+                result['message'] = woid if woid else stepresult['message']
+                return 'ERROR: Workflow step '+str(index)+' ('+step["action"]+') failed: '+msg
+            if step["action"] == 'create':
+                woid = stepresult['message']
+                stepresult['woid'] = woid
+        result['message'] = woid
+    return None
+
+
+class GatewayHandler(socketserver.StreamRequestHandler):
+    # One request per connection: a JSON line with the module params in, a JSON
+    # document with failed/msg/result out. Each connection gets its own thread
+    # and its own RequestState; GATEWAY_SLOTS caps how many run at once.
+    def handle(self):
+        gatewaybusy(1)
+        result = dict(
+            changed=False,
+            original_message='',
+            message=''
+        )
+        try:
+            params = json.loads(self.rfile.readline().decode())
+            with GATEWAY_SLOTS:
+                try:
+                    setup(params)
+                    msg = runaction(params, result)
+                    reporttimings(params, result)
+                except Exception as e:
+                    # Reported like the direct path reports it, not as a
+                    # gateway failure: the direct path would fail the same way.
+                    msg = "ERROR: "+params['action']+" failed: "+str(e)
+        except Exception as e:
+            msg = "Gateway error: "+str(e)
+        finally:
+            gatewaybusy(-1)
+        flushlog()
+        reply = {'failed': msg is not None, 'msg': msg, 'result': result}
+        self.wfile.write(json.dumps(reply).encode())
+
+
+def gatewaybusy(delta):
+    global GATEWAY_ACTIVE
+    global GATEWAY_LASTREQUEST
+    with GATEWAY_LOCK:
+        GATEWAY_ACTIVE += delta
+        GATEWAY_LASTREQUEST = time()
+
+
+def gatewaysocket(params):
+    if params["gateway_socket"]:
+        return params["gateway_socket"]
+    return params["token_dir"] + "/remedy_gateway_" + params["user"] + ".sock"
+
+
+def gatewaydrain(stop):
+    # Sends the operations queued through the gateway one batch at a time, on
+    # its own thread so that requests are not held up behind the drain. While
+    # the circuit is open it waits for the next probe; while the head of the
+    # outbox keeps failing it backs off, doubling the wait up to 5 minutes.
+    global GATEWAY_OUTBOX
+    delay = 5
+    while not stop.is_set():
+        if not GATEWAY_WAKE.wait(5):
+            continue
+        drainparams = GATEWAY_OUTBOX
+        drainresult = {}
+        try:
+            setup(drainparams)
+            allowed, retryin = circuitallow(drainparams)
+            if not allowed:
+                flushlog()
+                stop.wait(max(1, min(retryin, 300)))
+                continue
+            drainoutbox(drainparams, drainresult, maxbatches=1)
+        except Exception as e:
+            log("Gateway outbox drain error: "+str(e))
+        flushlog()
+        drain = drainresult.get('drain', {})
+        if 'drain' in drainresult and not drain['pending']:
+            delay = 5
+            with GATEWAY_LOCK:
+                if GATEWAY_OUTBOX is drainparams:
+                    GATEWAY_OUTBOX = None
+                    GATEWAY_WAKE.clear()
+        elif drain.get('sent') or drain.get('failed'):
+            delay = 5
+        else:
+            # Blocked on a pending operation or another drain: try again later.
+            stop.wait(delay)
+            delay = min(delay * 2, 300)
+
+
+def rungateway(socketpath, idletimeout, workers):
+    # Long-lived local gateway. Holds the pooled session, the token and every
+    # cache of this module between tasks, and exits after idletimeout seconds
+    # without requests.
+    global GATEWAY_LASTREQUEST
+    global GATEWAY_SLOTS
+    lock = filelock.FileLock(socketpath + ".lock")
+    try:
+        lock.acquire(timeout=0)
+    except filelock.Timeout:
+        return
+    try:
+        if os.path.exists(socketpath):
+            os.remove(socketpath)
+        oldmask = os.umask(0o077)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(socketpath, GatewayHandler)
+        finally:
+            os.umask(oldmask)
+        server.timeout = 5
+        GATEWAY_SLOTS = threading.BoundedSemaphore(max(1, workers))
+        GATEWAY_LASTREQUEST = time()
+        stop = threading.Event()
+        drainer = threading.Thread(target=gatewaydrain, args=(stop,))
+        drainer.start()
+        try:
+            while GATEWAY_ACTIVE > 0 or time() - GATEWAY_LASTREQUEST < idletimeout:
+                server.handle_request()
+        finally:
+            # Closing the server waits for the requests still running.
+            server.server_close()
+            stop.set()
+            drainer.join()
+            os.remove(socketpath)
+    finally:
+        lock.release()
+
+
+def gatewayimports(script):
+    # The gateway runs from a plain copy of this module, outside the AnsiballZ
+    # wrapper that brings ansible along, so sys.executable must have ansible
+    # installed. A failed check is remembered for an hour next to the script
+    # so that every task does not pay for it again.
+    marker = script + ".noimport"
+    if os.path.exists(marker) and time() - os.path.getmtime(marker) < 3600:
+        return False
+    check = subprocess.run([sys.executable, "-c", "import ansible.module_utils.basic, filelock, requests, concurrent_log_handler"],
+                           stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=60)
+    if check.returncode != 0:
+        with open(marker, 'w') as f:
+            f.write(check.stderr.decode(errors='replace'))
+        log("Remedy gateway not started: "+sys.executable+" cannot import the module dependencies (see "+marker+")")
+        return False
+    if os.path.exists(marker):
+        os.remove(marker)
+    return True
+
+
+def startgateway(params):
+    # Start the gateway in the background from a copy of this module's source.
+    # The current task does not wait for it and keeps using the direct path.
+    # The gateway's stderr goes to remedy_gateway.log in token_dir.
+    socketpath = gatewaysocket(params)
+    script = params["token_dir"] + "/remedy_gateway.py"
+    try:
+        if not gatewayimports(script):
+            return
+        source = inspect.getsource(sys.modules[__name__])
+        if not os.path.exists(script) or open(script).read() != source:
+            with open(script + ".tmp", 'w') as f:
+                f.write(source)
+            os.replace(script + ".tmp", script)
+        with open(params["token_dir"] + "/remedy_gateway.log", 'a') as errors:
+            subprocess.Popen([sys.executable, script, "--gateway", socketpath, str(params["gateway_idle_timeout"]), str(CONST_POOLSIZE)],
+                             stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=errors,
+                             close_fds=True, start_new_session=True)
+        log("Remedy gateway started (socket: "+socketpath+")")
+    except Exception as e:
+        log("Could not start Remedy gateway: "+str(e))
+
+
+def gatewayrequest(params):
+    # Hand the request to a running gateway. Returns its reply, or None when no
+    # gateway is listening so the caller falls back to the direct path. Raises
+    # socket.timeout when the gateway does not answer within gateway_timeout.
+    socketpath = gatewaysocket(params)
+    if not os.path.exists(socketpath):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(params["connect_timeout"])
+        client.connect(socketpath)
+    except (OSError, socket.timeout):
+        client.close()
+        return None
+    try:
+        client.settimeout(params["gateway_timeout"])
+        client.sendall(json.dumps(params).encode() + b"\n")
+        client.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            try:
+                chunk = client.recv(65536)
+            except socket.timeout:
+                raise socket.timeout("no reply from the gateway within "+str(params["gateway_timeout"])+"s")
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return json.loads(b"".join(chunks).decode())
+    finally:
+        client.close()
+
+
+def run_module():
     # define available arguments/parameters a user can pass to the module
     module_args = dict(
         token_dir=dict(type='str', required=True),
         user=dict(type='str', required=True),
         password=dict(type='str', required=True, no_log=True),
         apibase=dict(type='str', required=True),
-        action=dict(type='str', choices=['create', 'modify', 'add_attachment'], required=True),
-        data=dict(type='dict', required=True),
+        action=dict(type='str', choices=['create', 'create_batch', 'modify', 'add_attachment', 'modify_bulk', 'workflow', 'search',
+                                             'outbox_drain', 'outbox_status'], required=True),
+        data=dict(type='dict', required=False),
+        items=dict(type='list', elements='dict', required=False),
+        steps=dict(type='list', elements='dict', required=False),
+        qualification=dict(type='str', required=False),
+        fields=dict(type='list', elements='str', required=False),
+        page_size=dict(type='int', required=False, default=500),
+        output=dict(type='path', required=False),
+        async_outbox=dict(type='bool', required=False, default=False),
+        outbox_db=dict(type='path', required=False),
+        operation_id=dict(type='int', required=False),
+        batch_size=dict(type='int', required=False, default=50),
+        circuit_threshold=dict(type='int', required=False, default=5),
+        circuit_cooldown=dict(type='int', required=False, default=60),
+        circuit_queue=dict(type='bool', required=False, default=False),
+        concurrency=dict(type="int", required=False, default=5),
         woid=dict(type='str', required=False),
         filename=dict(type='str', required=False),
+        filenames=dict(type='list', elements='str', required=False),
         logfile=dict(type="str", required=False, default="None"),
         log=dict(type="bool", required=False, default=False),
         log_identifier=dict(type="str", required=False, default=""),
+        timings=dict(type="bool", required=False, default=False),
+        log_mode=dict(type="str", required=False, default="sync", choices=["sync", "queue"]),
+        pool_size=dict(type="int", required=False, default=10),
+        connect_timeout=dict(type="int", required=False, default=10),
+        read_timeout=dict(type="int", required=False, default=300),
+        gateway=dict(type="bool", required=False, default=False),
+        gateway_socket=dict(type="str", required=False),
+        gateway_idle_timeout=dict(type="int", required=False, default=900),
+        gateway_timeout=dict(type="int", required=False, default=600),
+        token_refresh_margin=dict(type="int", required=False, default=60),
+        token_lock_timeout=dict(type="int", required=False, default=60),
+        retries=dict(type="int", required=False, default=3),
+        retry_delay=dict(type="float", required=False, default=1.0),
+        retry_max_delay=dict(type="float", required=False, default=30.0),
+        entryid_cache_size=dict(type="int", required=False, default=1000),
+        resolve_chunk_size=dict(type="int", required=False, default=100),
+        only_changed=dict(type="bool", required=False, default=True),
     )
 
     # seed the result dict in the object
@@ -360,6 +1647,17 @@ def run_module():
     # supports check mode
     module = AnsibleModule(
         argument_spec=module_args,
+        required_if=[
+            ('action', 'create', ['data']),
+            ('action', 'create_batch', ['items']),
+            ('action', 'modify', ['data', 'woid']),
+            ('action', 'add_attachment', ['data', 'woid']),
+            ('action', 'add_attachment', ('filename', 'filenames'), True),
+            ('action', 'modify_bulk', ['items']),
+            ('action', 'workflow', ['steps']),
+            ('action', 'search', ['qualification', 'output']),
+            ('action', 'outbox_status', ['operation_id']),
+        ],
         supports_check_mode=False
     )
 
@@ -368,99 +1666,46 @@ def run_module():
     # state with no modifications
     if module.check_mode:
         module.exit_json(**result)
-    fname = module.params["token_dir"] + "/token_"+module.params['user']+".txt"
-    if not os.path.exists(fname):
-        with open(fname, 'a') as f:
-            f.write("")
-            f.close()
-        refreshtoken(module.params["token_dir"], module.params["apibase"], module.params["user"], module.params["password"])
-    CONST_TOKENFILE = fname
-    if module.params["log"]:
-        if module.params["logfile"] == "None":
-          CONST_MESSAGE += "Logging file not specified. Logging NOT enabled"
-          LOG=False
-        else:
-            try:
-                LOG_HANDLER = getLogger(__name__)
-                # Use an absolute path to prevent file rotation trouble.
-                logfile = os.path.abspath(module.params["logfile"])
-                # Rotate log after reaching 100M, keep 5 old copies.
-                rotateHandler = ConcurrentRotatingFileHandler(logfile, "a", 100*1024*1024, 3)
-                LOG_HANDLER.addHandler(rotateHandler)
-                LOG_HANDLER.setLevel(INFO)
-                LOG = True
-                LOG_ID = module.params["log_identifier"]
-            except Exception as e:
-                CONST_MESSAGE += "Could not create logfile. Logging NOT enabled: "+str(e)
-                LOG = False
-    
-
-
-    # manipulate or modify the state as
-    # needed (this is going to be the
-    # part where your module will do what it needs to do)
-    result['original_message'] = module.params['action']
-    #module.params["data"] = str(module.params["data"].encode("ascii","replace"))
-    # use whatever logic you need to determine whether or not this module
-    # made any modifications to your target
-    if module.params['action'] == 'create':
-        for i in range(CONST_NUMRETRIES):
-            try:
-                response = create(module.params["token_dir"], module.params["apibase"], module.params["data"])
-                result['message'] = response.text
-                if response.status_code <= 204:
-                    result["message"] = json.loads(response.text)["values"]["WorkOrder_ID"]
-                    result['changed'] = True
-                    break
-                elif response.status_code >= 400:
-                    refreshtoken(module.params['token_dir'], module.params['apibase'], module.params['user'], module.params['password'])
-            except Exception as e:
-                result['message']=str(e)
-        if not result['changed']:
-            result['message'] += CONST_MESSAGE
-            module.fail_json(msg='ERROR: Could not create Work Order', **result)
-        else:
-            module.exit_json(**result)
 
-    elif module.params['action'] == 'add_attachment':
-        for i in range(CONST_NUMRETRIES):
-            try:
-                response = addattachment(module.params["token_dir"], module.params["apibase"], module.params["woid"], module.params["data"], module.params["filename"])
-                if response.status == 201:
-                    result['changed'] = True
-                    result['message'] = response.read()
-                    break
-                elif response.status >= 400:
-                    refreshtoken(module.params['token_dir'], module.params['apibase'], module.params['user'], module.params['password'])
-            except:
-                refreshtoken(module.params['token_dir'], module.params['apibase'], module.params['user'], module.params['password'])
-        if not result['changed']:
-            result['message'] += CONST_MESSAGE
-            module.fail_json(msg='ERROR: Could not attach file to Work Order', **result)
-        else:
-            module.exit_json(**result)
+    fallback = ""
+    if module.params["gateway"]:
+        try:
+            reply = gatewayrequest(module.params)
+        except Exception as e:
+            fallback = "Remedy gateway unavailable, using direct connection: "+str(e)
+            reply = None
+        if reply is not None:
+            reply["result"]["gateway"] = True
+            if reply["failed"]:
+                module.fail_json(msg=reply["msg"], **reply["result"])
+            module.exit_json(**reply["result"])
 
-    elif module.params['action'] == 'modify':
-        for i in range(CONST_NUMRETRIES):
-            try:
-                response = modify(module.params["token_dir"], module.params["apibase"], module.params["woid"], module.params["data"])
-                if response.status_code == 204:
-                    result['changed'] = True
-                    result['message'] = response.text
-                    break
-                elif response.status_code >= 400:
-                    result['message'] = response.text
-                    refreshtoken(module.params['token_dir'], module.params['apibase'], module.params['user'], module.params['password'])
-            except Exception as e:
-                result['message'] = str(e)
-        if not result['changed']:
-            result['message'] += CONST_MESSAGE
-            module.fail_json(msg='ERROR: Could not modify Work Order', **result)
-        else:
-            module.exit_json(**result)
+    try:
+        setup(module.params)
+        request().message += fallback
+        if module.params["gateway"]:
+            startgateway(module.params)
+
+        # manipulate or modify the state as
+        # needed (this is going to be the
+        # part where your module will do what it needs to do)
+        #module.params["data"] = str(module.params["data"].encode("ascii","replace"))
+        # use whatever logic you need to determine whether or not this module
+        # made any modifications to your target
+        msg = runaction(module.params, result)
+        reporttimings(module.params, result)
+    except Exception as e:
+        msg = "ERROR: "+module.params['action']+" failed: "+str(e)
+    if msg is not None:
+        module.fail_json(msg=msg, **result)
+    else:
+        module.exit_json(**result)
 
 def main():
-    run_module()
+    if len(sys.argv) == 5 and sys.argv[1] == "--gateway":
+        rungateway(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]))
+    else:
+        run_module()
 
 
 if __name__ == '__main__':